@@ -0,0 +1,506 @@
+#! /usr/bin/env python3
+
+# Benchmarks of compiling the mesh on synthetic topologies, e.g.
+#   ./bench.py routing --topology star tree --hosts 100 500 1000 2000
+#   ./bench.py compile --topology star --hosts 1000 --budget 10 --json compile.json
+#   ./bench.py scale --hosts 10 100 1000 10000 --json scale.json
+# and of the traffic through the mock net, which needs root:
+#   ./bench.py dataplane --mtu 1280 1360 1420 --json dataplane.json
+
+import argparse
+import gc
+import json
+import os
+import resource
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+from mesh import (IPSet, IPSetBundle, IPTableRule, Daemon, Key, NS, Network, Route, RouteRule, Routes, Wg, WgIface,
+                  listening, supervisor)
+
+
+def link_cidr(i: int):
+    # the i-th /30 in 10.0.0.0/8
+    return f"10.{(i >> 14) & 255}.{(i >> 6) & 255}.{(i & 63) * 4}/30"
+
+
+def topology_edges(topology: str, n: int):
+    if topology == "star":
+        return [(0, i) for i in range(1, n)]
+    if topology == "tree":
+        # a 4-ary tree
+        return [((i - 1) // 4, i) for i in range(1, n)]
+    if topology == "mesh":
+        return [(i, j) for i in range(n) for j in range(i + 1, n)]
+    raise ValueError(f"unknown topology {topology}")
+
+
+# count_edges is len(topology_edges(topology, n)) without building them
+def count_edges(topology: str, n: int):
+    if topology == "mesh":
+        return n * (n - 1) // 2
+    if topology in ("star", "tree"):
+        return max(n - 1, 0)
+    raise ValueError(f"unknown topology {topology}")
+
+
+def gen_network(topology: str, n: int, mock_net: bool = False):
+    net = Network(mock_net=mock_net)
+    # the keys are not touched unless the links are built, the mock net needs the real ones
+    keys = Key.gen_many(n) if mock_net else [Key(None, "sk", "pk")] * n
+    for i in range(n):
+        net.add_host(f"h{i}", f"100.{64 + i // 256}.{i % 256}.1", keys[i])
+    for j, (l, r) in enumerate(topology_edges(topology, n)):
+        net.connect(f"h{l}", f"h{r}", link_cidr(j), 10000 + j % 50000)
+    return net
+
+
+# every host egresses through h0, by two bundles shared by all hosts as example.py does
+def add_policies(net: Network, n: int):
+    bundles = [IPSetBundle(match=[], not_match=[]) for _ in range(2)]
+    for i in range(1, n):
+        for b in bundles:
+            net.output_to_nat_gateway(b, f"h{i}", "h0")
+
+
+def bench_routing(topology: str, n: int):
+    net = gen_network(topology, n)
+    add_policies(net, n)
+
+    start = time.perf_counter()
+    net._pass_1_compute_static_route()
+    static_route = time.perf_counter() - start
+    start = time.perf_counter()
+    net._pass_2_output_to_nat_gateway()
+    nat = time.perf_counter() - start
+
+    routes = sum(len(c) for h in net.hosts.values() for c in h.confs.conf if hasattr(c, "routes"))
+    print(f"{topology:>5} hosts={n:<6} links={len(net.links):<8} routes={routes:<10} "
+          f"static_route={static_route:.3f}s nat={nat:.3f}s")
+
+
+# bench_compile compiles the whole mesh and plans the bring-up of the hub h0 and a leaf, no root is needed
+def bench_compile(topology: str, n: int):
+    net = gen_network(topology, n)
+    add_policies(net, n)
+
+    start = time.perf_counter()
+    net.compile()
+    compile_time = time.perf_counter() - start
+    start = time.perf_counter()
+    hub = net.plan("h0")
+    leaf = net.plan(f"h{n - 1}")
+    plan_time = time.perf_counter() - start
+
+    lines = lambda records: sum(1 + len((r["input"] or "").splitlines()) for r in records)
+    r = {"topology": topology, "hosts": n, "links": len(net.links), "compile": compile_time, "plan": plan_time,
+         "hub_cmds": len(hub), "hub_lines": lines(hub), "leaf_cmds": len(leaf), "leaf_lines": lines(leaf)}
+    print(f"{topology:>5} hosts={n:<6} links={len(net.links):<8} compile={compile_time:.3f}s plan={plan_time:.3f}s "
+          f"hub={r['hub_cmds']} cmds/{r['hub_lines']} lines leaf={r['leaf_cmds']} cmds/{r['leaf_lines']} lines")
+    return r
+
+
+# count_objects counts the kernel objects generated for all hosts
+def count_objects(net: Network):
+    counts = {"routes": 0, "ip_rules": 0, "iptables_rules": 0, "ipsets": 0, "set_entries": 0, "wg_ifaces": 0,
+              "wg_peers": 0}
+    for h in net.hosts.values():
+        for c in h.confs.conf:
+            if type(c) == Routes:
+                counts["routes"] += len(c)
+            elif type(c) == Route:
+                counts["routes"] += 1
+            elif type(c) == RouteRule:
+                counts["ip_rules"] += 1
+            elif type(c) == IPTableRule:
+                counts["iptables_rules"] += 1
+            elif type(c) == IPSet:
+                counts["ipsets"] += 1
+                counts["set_entries"] += len(c.ips)
+            elif type(c) == Wg:
+                counts["wg_ifaces"] += 1
+                counts["wg_peers"] += 1
+            elif type(c) == WgIface:
+                counts["wg_ifaces"] += 1
+                counts["wg_peers"] += len(c.peers)
+    return counts
+
+
+def gen_scale_network(topology: str, n: int, mock_net: bool = False):
+    net = gen_network(topology, n, mock_net)
+    add_policies(net, n)
+    return net
+
+
+def bench_scale(topology: str, n: int, memory: bool, mock: bool):
+    r = {"topology": topology, "hosts": n}
+    net = gen_scale_network(topology, n)
+    r["links"] = len(net.links)
+    start = time.perf_counter()
+    net.compile()
+    r["compile"] = time.perf_counter() - start
+    r.update(count_objects(net))
+    del net
+
+    if memory:
+        # compiled again under tracemalloc, which slows it down
+        gc.collect()
+        tracemalloc.start()
+        net = gen_scale_network(topology, n)
+        net.compile()
+        r["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del net
+
+    if mock:
+        net = gen_scale_network(topology, n, mock_net=True)
+        net.compile()
+        hosts = list(net.hosts)
+        net.up_mock_net()
+        try:
+            start = time.perf_counter()
+            net.up_hosts(hosts)
+            r["mock_up"] = time.perf_counter() - start
+            start = time.perf_counter()
+            net.down_hosts(hosts)
+            r["mock_down"] = time.perf_counter() - start
+        finally:
+            net.down_mock_net()
+
+    print(f"{topology:>5} hosts={n:<6} links={r['links']:<8} compile={r['compile']:.3f}s "
+          + (f"peak={r['peak_memory'] / 2**20:.1f}MiB " if memory else "")
+          + f"routes={r['routes']} ip_rules={r['ip_rules']} iptables_rules={r['iptables_rules']} "
+          + f"set_entries={r['set_entries']} wg_peers={r['wg_peers']}"
+          + (f" mock_up={r['mock_up']:.3f}s mock_down={r['mock_down']:.3f}s" if mock else ""), flush=True)
+    return r
+
+
+# the data plane bench: a client host egressing through a nat gateway host to a server outside the mesh
+DP_CLIENT, DP_GATEWAY, DP_SERVER = "dp-cli", "dp-gw", "dp-srv"
+DP_SERVER_IP = "50.0.1.1"
+DP_LINK = "10.0.0.0/30" # the client is 10.0.0.1 and the gateway 10.0.0.2
+DP_PORT = 5201 # the sink, the echo server listens on the next port
+
+
+def gen_dataplane_network(mtu: int):
+    net = Network(mock_net=True, mtu=mtu)
+    keys = Key.gen_many(3)
+    net.add_host(DP_CLIENT, "", keys[0])
+    net.add_host(DP_GATEWAY, "40.0.1.1", keys[1])
+    # the server is not connected to the mesh, it is reached through the mock net only
+    net.add_host(DP_SERVER, DP_SERVER_IP, keys[2])
+    net.connect(DP_CLIENT, DP_GATEWAY, DP_LINK, 10000)
+    server = IPSetBundle(match=[IPSet("dp-server", [DP_SERVER_IP])], not_match=[])
+    net.output_to_nat_gateway(server, DP_CLIENT, DP_GATEWAY)
+    return net
+
+
+def dataplane_server(port: int):
+    """
+    Runs in a namespace: a tcp and an udp sink on `port`, and a tcp and an udp echo server on `port + 1`.
+    The udp sink replies the bytes received from a sender when the sender sends b"END".
+    """
+    def tcp(port: int, echo: bool):
+        s = socket.socket()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(("0.0.0.0", port))
+        s.listen(16)
+        while True:
+            c, _ = s.accept()
+            threading.Thread(target=tcp_conn, args=(c, echo), daemon=True).start()
+
+    def tcp_conn(c: socket.socket, echo: bool):
+        c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with c:
+            while True:
+                data = c.recv(1 << 16)
+                if not data:
+                    break
+                if echo:
+                    c.sendall(data)
+
+    def udp(port: int, echo: bool):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 24)
+        s.bind(("0.0.0.0", port))
+        received = {} # sender -> bytes
+        while True:
+            data, addr = s.recvfrom(1 << 16)
+            if echo:
+                s.sendto(data, addr)
+            elif data == b"END":
+                s.sendto(str(received.pop(addr, 0)).encode(), addr)
+            else:
+                received[addr] = received.get(addr, 0) + len(data)
+
+    threads = [threading.Thread(target=f, args=(port + echo, echo), daemon=True)
+               for f in (tcp, udp) for echo in (False, True)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def percentile(xs: list, q: float):
+    if len(xs) == 0:
+        return float("nan")
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+
+def dataplane_client(mode: str, host: str, port: int, duration: float, size: int):
+    """
+    Runs in a namespace, prints the result of `mode` as JSON:
+    "tcp_stream" and "udp_stream" send to the sink for `duration` seconds,
+    "tcp_rr" and "udp_rr" send `size` bytes (at least 8 for "udp_rr") to the echo server and wait for them one at a time.
+    """
+    r = {}
+    if mode == "tcp_stream":
+        s = socket.create_connection((host, port))
+        buf = b"x" * (1 << 16)
+        sent = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            s.sendall(buf)
+            sent += len(buf)
+        # the sink closes after reading everything
+        s.shutdown(socket.SHUT_WR)
+        s.recv(1)
+        r = {"bytes": sent, "seconds": time.perf_counter() - start}
+    elif mode == "udp_stream":
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect((host, port))
+        buf = b"x" * size
+        sent = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            try:
+                sent += s.send(buf)
+            except OSError:
+                # ENOBUFS, the queue of the device is full
+                pass
+        seconds = time.perf_counter() - start
+        s.settimeout(0.2)
+        received = None
+        for _ in range(25):
+            s.send(b"END")
+            try:
+                received = int(s.recv(64))
+                break
+            except socket.timeout:
+                pass
+        assert(received is not None)
+        r = {"bytes": received, "sent": sent, "seconds": seconds}
+    elif mode == "tcp_rr":
+        s = socket.create_connection((host, port + 1))
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buf = b"x" * size
+        rtts = []
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            t = time.perf_counter()
+            s.sendall(buf)
+            got = 0
+            while got < size:
+                got += len(s.recv(1 << 16))
+            rtts.append(time.perf_counter() - t)
+        r = {"requests": len(rtts), "lost": 0, "p50": percentile(rtts, 0.5), "p99": percentile(rtts, 0.99)}
+    else:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect((host, port + 1))
+        # a request starts with its sequence number, so a late reply to a lost one is not taken for the next reply
+        pad = b"x" * max(0, size - 8)
+        rtts = []
+        lost = 0
+        seq = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            seq += 1
+            tag = struct.pack("Q", seq)
+            t = time.perf_counter()
+            s.send(tag + pad)
+            while True:
+                timeout = t + 1 - time.perf_counter()
+                data = None
+                if timeout > 0:
+                    s.settimeout(timeout)
+                    try:
+                        data = s.recv(1 << 16)
+                    except socket.timeout:
+                        pass
+                if data is None:
+                    lost += 1
+                    break
+                if data[:8] == tag:
+                    rtts.append(time.perf_counter() - t)
+                    break
+        r = {"requests": len(rtts), "lost": lost, "p50": percentile(rtts, 0.5), "p99": percentile(rtts, 0.99)}
+    print(json.dumps(r))
+
+
+# busy_cpu returns the cpu seconds spent by all processes and the kernel, the crypto of wireguard runs in the kernel
+def busy_cpu():
+    with open("/proc/stat") as f:
+        fields = [int(x) for x in f.readline().split()[1:]]
+    # idle and iowait
+    return (sum(fields) - fields[3] - fields[4]) / os.sysconf("SC_CLK_TCK")
+
+
+def run_dataplane_client(mode: str, host: str, duration: float, size: int):
+    cmd = f"{sys.executable} {os.path.realpath(__file__)} dataplane-client {mode} {host} {DP_PORT} {duration} {size}"
+    cpu = busy_cpu()
+    r = json.loads(NS(DP_CLIENT).run(cmd).stdout)
+    cpu = busy_cpu() - cpu
+    if "bytes" in r:
+        r["gbps"] = r["bytes"] * 8 / r["seconds"] / 1e9
+        r["cpu_ns_per_byte"] = cpu * 1e9 / r["bytes"] if r["bytes"] else None
+    return r
+
+
+# the paths and the modes measured on them, the tcp through the gateway is redirected to its any_proxy
+DP_PATHS = [
+    ("direct", "10.0.0.2", ["tcp_stream", "udp_stream", "tcp_rr", "udp_rr"]),
+    ("policy", DP_SERVER_IP, ["udp_stream", "udp_rr"]),
+    ("proxied", DP_SERVER_IP, ["tcp_stream", "tcp_rr"]),
+]
+
+
+def bench_dataplane(mtu: int, duration: float, udp_size: int, rr_size: int):
+    # any_proxy wants to open many files
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = []
+    net = gen_dataplane_network(mtu)
+    net.compile()
+    hosts = list(net.hosts)
+    net.up_mock_net()
+    try:
+        net.up_hosts(hosts)
+        servers = []
+        try:
+            for name in (DP_GATEWAY, DP_SERVER):
+                ns = NS(name)
+                cmd = f"{sys.executable} {os.path.realpath(__file__)} dataplane-server --port {DP_PORT}"
+                d = Daemon("dataplane-server", cmd,
+                           lambda ns=ns: listening(ns, "tcp", DP_PORT + 1) and listening(ns, "udp", DP_PORT + 1), ns)
+                supervisor.start(d)
+                servers.append(d)
+
+            for path, host, modes in DP_PATHS:
+                for mode in modes:
+                    # the udp datagrams fill the mtu of the tunnel
+                    size = rr_size if mode.endswith("_rr") else (udp_size or mtu - 28)
+                    r = {"mtu": mtu, "path": path, "mode": mode, "size": size}
+                    r.update(run_dataplane_client(mode, host, duration, size))
+                    results.append(r)
+                    if "gbps" in r:
+                        print(f"mtu={mtu} {path:>7} {mode:>10} {r['gbps']:.3f}Gbit/s "
+                              f"cpu={r['cpu_ns_per_byte']:.2f}ns/B"
+                              + (f" sent={r['sent'] * 8 / r['seconds'] / 1e9:.3f}Gbit/s" if "sent" in r else ""))
+                    else:
+                        print(f"mtu={mtu} {path:>7} {mode:>10} p50={r['p50'] * 1e6:.0f}us p99={r['p99'] * 1e6:.0f}us "
+                              f"requests={r['requests']} lost={r['lost']}")
+        finally:
+            for d in servers:
+                supervisor.stop(d)
+            net.down_hosts(hosts)
+    finally:
+        net.down_mock_net()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="wg-mesh benchmarks")
+    subparsers = parser.add_subparsers(dest="bench")
+    subparsers.required = True
+
+    routing = subparsers.add_parser("routing", help="the static route and the nat gateway path computation")
+    routing.add_argument("--topology", nargs="+", default=["star", "tree"], choices=["star", "tree", "mesh"])
+    routing.add_argument("--hosts", nargs="+", type=int, default=[100, 500, 1000, 2000])
+
+    compile = subparsers.add_parser("compile", help="compiling the mesh and planning the bring-up, for CI")
+    compile.add_argument("--topology", nargs="+", default=["star", "tree"], choices=["star", "tree", "mesh"])
+    compile.add_argument("--hosts", nargs="+", type=int, default=[100, 1000])
+    compile.add_argument("--json", type=str, metavar="PATH", help="write the results to PATH")
+    compile.add_argument("--budget", type=float, metavar="SECONDS",
+                         help="fail if compiling and planning any topology takes longer")
+
+    scale = subparsers.add_parser("scale", help="compile time, peak memory and the kernel objects at scale")
+    scale.add_argument("--topology", nargs="+", default=["star", "tree", "mesh"], choices=["star", "tree", "mesh"])
+    scale.add_argument("--hosts", nargs="+", type=int, default=[10, 100, 1000, 10000])
+    scale.add_argument("--max-links", type=int, default=200000,
+                       help="skip the topologies with more links, e.g. a full mesh of 1000 hosts")
+    scale.add_argument("--no-memory", action="store_true", help="skip measuring the peak memory")
+    scale.add_argument("--mock-hosts", type=int, default=0, metavar="N",
+                       help="bring the topologies of at most N hosts up and down on the mock net, which needs root")
+    scale.add_argument("--json", type=str, metavar="PATH", help="write the results to PATH")
+
+    dataplane = subparsers.add_parser("dataplane", help="the throughput and latency through the mock net, needs root")
+    dataplane.add_argument("--mtu", nargs="+", type=int, default=[1280, 1360, 1420])
+    dataplane.add_argument("--duration", type=float, default=5, metavar="SECONDS", help="of each measurement")
+    dataplane.add_argument("--udp-size", type=int, default=0,
+                           help="the size of the udp datagrams streamed, defaults to filling the mtu")
+    dataplane.add_argument("--rr-size", type=int, default=1, help="the size of the requests and responses")
+    dataplane.add_argument("--json", type=str, metavar="PATH", help="write the results to PATH")
+
+    # run by `dataplane` in the namespaces
+    server = subparsers.add_parser("dataplane-server")
+    server.add_argument("--port", type=int, default=DP_PORT)
+    client = subparsers.add_parser("dataplane-client")
+    client.add_argument("mode", choices=["tcp_stream", "udp_stream", "tcp_rr", "udp_rr"])
+    client.add_argument("host")
+    client.add_argument("port", type=int)
+    client.add_argument("duration", type=float)
+    client.add_argument("size", type=int)
+
+    args = parser.parse_args()
+    if args.bench == "routing":
+        for topology in args.topology:
+            for n in args.hosts:
+                bench_routing(topology, n)
+
+    if args.bench == "compile":
+        results = [bench_compile(topology, n) for topology in args.topology for n in args.hosts]
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=1)
+        slow = [r for r in results if args.budget and r["compile"] + r["plan"] > args.budget]
+        for r in slow:
+            print(f"{r['topology']} with {r['hosts']} hosts is over the budget of {args.budget}s")
+        if slow:
+            sys.exit(1)
+
+    if args.bench == "dataplane":
+        results = []
+        for mtu in args.mtu:
+            results += bench_dataplane(mtu, args.duration, args.udp_size, args.rr_size)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=1)
+
+    if args.bench == "dataplane-server":
+        dataplane_server(args.port)
+
+    if args.bench == "dataplane-client":
+        dataplane_client(args.mode, args.host, args.port, args.duration, args.size)
+
+    if args.bench == "scale":
+        results = []
+        for topology in args.topology:
+            for n in args.hosts:
+                if count_edges(topology, n) > args.max_links:
+                    print(f"{topology:>5} hosts={n:<6} skipped, more than {args.max_links} links", flush=True)
+                    continue
+                results.append(bench_scale(topology, n, not args.no_memory, n <= args.mock_hosts))
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
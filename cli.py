@@ -1,10 +1,14 @@
 import argparse
 import os
+import runpy
 import signal
 import sys
+import tempfile
 import time
+import traceback
 
-from mesh import Key, Wg
+import runner
+from mesh import IPSet, Key, NS, command_runner, supervisor
 
 key_dir = os.path.join(
     os.path.dirname(os.path.realpath(__file__)),
@@ -18,23 +22,89 @@ def get_key(host: str, tmp_key: bool):
         return Key(os.path.join(key_dir, f"{host}.key"))
 
 
+# print_ipsets prints the size of the ipsets of a running host
+def print_ipsets(net, host: str):
+    for c in net.hosts[host].confs.conf:
+        if type(c) == IPSet:
+            r = c.report()
+            if r:
+                print(f"ipset {c.name}: {r['entries']} entries, {r['prefix_lengths']} prefix lengths, "
+                      + f"{r['memory']} bytes in memory ({r['header']})")
+
+
+# the pid of the running `up`, which `reload` signals
+def pid_path(host: str):
+    return os.path.join(tempfile.gettempdir(), f"wg-mesh-{host}.pid")
+
+
 class Killer(object):
     def __init__(self):
         self.shutdown = False
+        self.reload = False
         signal.signal(signal.SIGINT, self.kill)
         signal.signal(signal.SIGTERM, self.kill)
+        signal.signal(signal.SIGHUP, self.hup)
 
     def kill(self, signum, frame):
         print("Shutting down...")
         self.shutdown = True
-    
-    def wait(self):
-        while not self.shutdown:
+
+    def hup(self, signum, frame):
+        self.reload = True
+
+    # wait returns on shutdown, or on reload if `reload` is set
+    def wait(self, reload=False):
+        while not self.shutdown and not (reload and self.reload):
             time.sleep(0.1)
+        self.reload = False
+
+
+def add_profile_args(parser):
+    parser.add_argument('--profile', type=str, metavar='PATH',
+                        help='trace the compile passes, configs and commands, and write the trace to PATH')
+    parser.add_argument('--profile-format', choices=['chrome', 'json'], default='chrome',
+                        help='the Chrome trace events (chrome://tracing, Perfetto) or a plain list of spans')
+
+
+def start_profile(args):
+    if args.profile:
+        command_runner.tracer = runner.Tracer()
+
+
+# dump_profile writes the trace so far, it is written after bring-up and again after teardown
+def dump_profile(args):
+    if args.profile:
+        command_runner.tracer.dump(args.profile, args.profile_format)
+        print(f"Wrote the profile to {args.profile} ({len(command_runner.tracer.events)} spans)")
+
+
+# print_plan prints the commands of a plan under the configs running them, the private keys are hidden
+def print_plan(records):
+    owner = None
+    for r in records:
+        if r["owner"] != owner:
+            owner = r["owner"]
+            print(f"# {owner}")
+        cmd = NS(r["ns"]).gen_cmd(r["cmd"]) if r["ns"] else r["cmd"]
+        print(cmd + (" &" if r.get("daemon") else ""))
+        for l in (r["input"] or "").splitlines():
+            print("    " + ("PrivateKey = (hidden)" if l.startswith("PrivateKey") else l))
+
+
+# print_exited reports a crashed daemon before the supervisor restarts it
+def print_exited(d, code: int, backoff: float):
+    print(f"{d.name} exited with {code}, restarting in {backoff:.1f}s ({d.restarts} restarts so far)")
+
+
+# regen runs the config script again, so a reload picks up the edits of the topology
+def regen(gen):
+    path = sys.modules[gen.__module__].__file__
+    return runpy.run_path(path, run_name="__reload__")[gen.__name__]
 
 def mesh_main(gen):
-    tmp_net = gen(tmp_key=True, mock_net=False)
-    hosts = [n for n in tmp_net.hosts]
+    # the network is lazy, the keys are not loaded until they are used
+    net = gen(tmp_key=False, mock_net=False)
+    hosts = [n for n in net.hosts]
     # reserved host names
     assert('all' not in hosts)
     assert('hub' not in hosts)
@@ -44,66 +114,105 @@ def mesh_main(gen):
 
     parser_up = subparsers.add_parser('up')
     parser_up.add_argument('host', type=str, choices=hosts)
+    add_profile_args(parser_up)
+
+    parser_reload = subparsers.add_parser('reload', help='apply the changed configs to the running `up`')
+    parser_reload.add_argument('host', type=str, choices=hosts)
+
+    parser_plan = subparsers.add_parser('plan', help='print the commands bringing up the host without running them')
+    parser_plan.add_argument('host', type=str, choices=hosts)
+    parser_plan.add_argument('--mock', action='store_true')
+    parser_plan.add_argument('--tmp-key', action='store_true', help='use temporary keys instead of the ones in keys/')
 
     parser_mock = subparsers.add_parser('mock')
+    add_profile_args(parser_mock)
 
     parser_genkey = subparsers.add_parser('genkey')
     parser_genkey.add_argument('host', type=str, choices=['all'] + hosts)
 
+    parser_refresh = subparsers.add_parser('refresh-ipset')
+    parser_refresh.add_argument('host', type=str, choices=hosts)
+    parser_refresh.add_argument('--mock', action='store_true')
+
     parser_genclientconf = subparsers.add_parser('gen-client-conf')
     parser_genclientconf.add_argument('host', type=str, choices=hosts)
 
     args = parser.parse_args()
+    supervisor.on_exit = print_exited
 
     if args.cmd == 'up':
-        net = gen(tmp_key=False, mock_net=False)
+        killer = Killer()
+        start_profile(args)
         net.up(args.host)
+        print_ipsets(net, args.host)
         print(f'Started as: {args.host}')
-        Killer().wait()
+        dump_profile(args)
+        with open(pid_path(args.host), "w") as f:
+            f.write(str(os.getpid()))
+        while True:
+            killer.wait(reload=True)
+            if killer.shutdown:
+                break
+            print(f'Reloading {args.host}...')
+            try:
+                new_net = regen(gen)(tmp_key=False, mock_net=False)
+                steps = new_net.reload(args.host, net)
+                net = new_net
+                print(f'Reloaded, {sum(len(c) for _, c in steps)} configs changed')
+            except Exception:
+                traceback.print_exc()
+                print(f'Failed to reload {args.host}, the configs may be partially applied')
+        os.remove(pid_path(args.host))
         net.down(args.host)
+        dump_profile(args)
+
+    if args.cmd == 'reload':
+        with open(pid_path(args.host)) as f:
+            os.kill(int(f.read()), signal.SIGHUP)
     
+    if args.cmd == 'plan':
+        net = gen(tmp_key=args.tmp_key, mock_net=args.mock)
+        print_plan(net.plan(args.host))
+
     if args.cmd == 'mock':
         net = gen(tmp_key=False, mock_net=True)
+        start_profile(args)
         print("Preparing the mock network...")
         net.up_mock_net()
-        for h in hosts:
-            print(f"Starting {h}..")
-            net.up(h)
+        # the hosts are in their own namespaces, so they are brought up together
+        print(f"Starting {len(hosts)} hosts...")
+        net.up_hosts(hosts)
         print("The mock net is up!")
+        dump_profile(args)
         Killer().wait()
 
-        for h in hosts:
-            print(f"Shutting down {h}...")
-            net.down(h)
+        print(f"Shutting down {len(hosts)} hosts...")
+        net.down_hosts(hosts)
         print(f"Shutting down the mock network...")
         net.down_mock_net()
+        dump_profile(args)
+
 
+    if args.cmd == 'refresh-ipset':
+        if args.mock:
+            net = gen(tmp_key=False, mock_net=True)
+        net.refresh_ipsets(args.host)
+        print_ipsets(net, args.host)
 
     if args.cmd == 'genkey':
-        def gen_key(h):
-            key_path = os.path.join(key_dir, f"{h}.key")
-            assert(os.path.exists(key_path) == False)
-            k = Key(None)
-            k.dump(key_path)
-
-        if args.host == 'all':
-            for h in hosts: 
-                gen_key(h)
-        else:
-            gen_key(args.host)
+        names = hosts if args.host == 'all' else [args.host]
+        key_paths = [os.path.join(key_dir, f"{h}.key") for h in names]
+        for p in key_paths:
+            assert(os.path.exists(p) == False)
+
+        for p, k in zip(key_paths, Key.gen_many(len(names))):
+            k.dump(p)
 
     if args.cmd == 'gen-client-conf':
-        net = gen(tmp_key=False, mock_net=False)
         e = net.edges[args.host]
         assert(len(e) == 1) # only has one wg conf
         e = e[0]
-
-        wg = None
-        for c in net.hosts[args.host].confs.conf:
-            if type(c) == Wg:
-                wg = c
-                break
-        assert(wg != None)
+        port = net.endpoint_port(args.host, e[0])
 
         left = net.hosts[args.host]
         right = net.hosts[e[0]]
@@ -112,11 +221,11 @@ def mesh_main(gen):
 PrivateKey = {left.key.sk}
 Address = {e[1]}/30
 DNS = {e[2]}
-MTU = 1360
+MTU = {net.mtu}
 
 [Peer]
 PublicKey = {right.key.pk}
 AllowedIPs = 0.0.0.0/0, ::/0
-Endpoint = {right.wan_ip}:{wg.port}
+Endpoint = {right.wan_ip}:{port}
 PersistentKeepalive = 30
 """)
\ No newline at end of file
@@ -36,7 +36,7 @@ def gen_net(tmp_key: bool, mock_net: bool):
         net.connect(c, "bj", cidr, port)
     
     # define the ipset bundles used to match the destination ip later
-    chinaip = IPSet("chinaip", chinaip_list())
+    chinaip = IPSet("chinaip", chinaip_list)
     privateip = IPSet("privateip", privateip_list())
     chinaip_bundle = IPSetBundle(match=[chinaip], not_match=[])
     nonchinaip_bundle = IPSetBundle(match=[], not_match=[chinaip, privateip])
@@ -0,0 +1,200 @@
+#! /usr/bin/env python3
+import asyncio
+import base64
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+
+import netlink
+
+""" A long-lived privileged helper, which runs the commands of `mesh` with a single `sudo` per run.
+
+`Session` starts `sudo helper.py` once and streams the requests to it through a pipe, one JSON object per line:
+
+    {"id": 1, "op": "exec", "ns": "a", "cmd": "iptables-restore --noflush", "input": BASE64}
+    {"id": 2, "op": "ip", "ns": "a", "lines": ["link set wg-mesh up", ...]}
+
+The helper keeps one thread per namespace, which enters the namespace once and handles the requests of the
+namespace in order. A command is forked from that thread, so it inherits the namespace without `sudo` or
+`ip netns exec`, and the `ip` lines are applied through rtnetlink (see `netlink.py`) without spawning `ip` at all.
+"""
+
+
+# NSWorker handles the requests of one namespace in order, `ns_name` is `None` for the helper's own namespace
+class NSWorker(threading.Thread):
+    def __init__(self, ns_name, reply):
+        super().__init__(name=f"ns-{ns_name}", daemon=True)
+        self.ns_name = ns_name
+        self.reply = reply
+        self.requests = queue.Queue()
+        self.error = None
+
+    def run(self):
+        if self.ns_name is not None:
+            try:
+                fd = os.open(netlink.netns_path(self.ns_name), os.O_RDONLY)
+                try:
+                    netlink.setns(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                self.error = f"cannot enter {self.ns_name}: {e.strerror}"
+
+        while True:
+            req = self.requests.get()
+            if req is None:
+                break
+            try:
+                if self.error:
+                    raise RuntimeError(self.error)
+                self.reply(dict(self.handle(req), id=req["id"]))
+            except Exception as e:
+                self.reply({"id": req["id"], "error": str(e)})
+
+    def handle(self, req):
+        if req["op"] == "exec":
+            p = subprocess.run(req["cmd"], shell=True, input=base64.b64decode(req["input"]) if "input" in req else None,
+                               stdin=None if "input" in req else subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return {"returncode": p.returncode, "stdout": base64.b64encode(p.stdout).decode(),
+                    "stderr": base64.b64encode(p.stderr).decode()}
+        if req["op"] == "ip":
+            lines = req["lines"]
+            if all(l.startswith("netns ") for l in lines):
+                return {"errs": self.apply_netns(lines)}
+            # a new socket each time, its cached link indexes would go stale
+            with netlink.Netlink() as nl:
+                return {"errs": nl.apply(lines)}
+        raise ValueError(f"unknown op {req['op']}")
+
+    # namespaces are not managed by rtnetlink, their lines are run by `ip` one by one
+    def apply_netns(self, lines: list):
+        errs = [netlink.NOT_EXECUTED] * len(lines)
+        for i, l in enumerate(lines):
+            p = subprocess.run(f"ip {l}", shell=True, stdin=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if p.returncode != 0:
+                errs[i] = p.stderr.decode(errors="replace").strip()
+                break
+            errs[i] = None
+        return errs
+
+
+def serve(rfile, wfile):
+    lock = threading.Lock()
+    def reply(msg):
+        with lock:
+            wfile.write(json.dumps(msg).encode() + b"\n")
+            wfile.flush()
+
+    workers = {}
+    def stop(ns_name):
+        w = workers.pop(ns_name, None)
+        if w:
+            w.requests.put(None)
+            w.join()
+
+    for line in rfile:
+        req = json.loads(line)
+        ns_name = req.get("ns")
+        if req["op"] == "ip":
+            for l in req["lines"]:
+                # the thread staying in a namespace keeps it alive after it is deleted
+                if l.startswith("netns del "):
+                    stop(l.split()[2])
+        if ns_name not in workers:
+            workers[ns_name] = NSWorker(ns_name, reply)
+            workers[ns_name].start()
+        workers[ns_name].requests.put(req)
+
+    for ns_name in list(workers):
+        stop(ns_name)
+
+
+class Session(object):
+    """
+    Session is the client of the helper, used by `runner.Runner` on its event loop.
+    `root_ns` is the name standing for the namespace the helper runs in.
+    `cmd` starts the helper, which is `sudo helper.py` unless running as root already.
+    """
+    def __init__(self, root_ns: str = None, cmd: list = None):
+        self.root_ns = root_ns
+        if cmd is None:
+            cmd = [sys.executable, os.path.realpath(__file__)]
+            if os.geteuid() != 0:
+                cmd = ["sudo"] + cmd
+        self.cmd = cmd
+        self.p = None
+        self.reader = None
+        self.start_lock = None
+        self.next_id = 0
+        self.pending = {} # id -> future
+
+    async def start(self):
+        if self.start_lock is None:
+            self.start_lock = asyncio.Lock()
+        async with self.start_lock:
+            if self.p is not None:
+                return
+            # a reply carries the whole output of a command in one line
+            self.p = await asyncio.create_subprocess_exec(*self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                          limit=1 << 26)
+            self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        while True:
+            line = await self.p.stdout.readline()
+            if not line:
+                break
+            msg = json.loads(line)
+            self.pending.pop(msg["id"]).set_result(msg)
+        for fut in self.pending.values():
+            fut.set_exception(RuntimeError("the privileged helper exited"))
+        self.pending = {}
+
+    async def request(self, req: dict):
+        if self.p is None:
+            await self.start()
+        if self.p.returncode is not None:
+            raise RuntimeError("the privileged helper exited")
+        self.next_id += 1
+        req["id"] = self.next_id
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[req["id"]] = fut
+        self.p.stdin.write(json.dumps(req).encode() + b"\n")
+        await self.p.stdin.drain()
+        msg = await fut
+        if "error" in msg:
+            raise RuntimeError(f"privileged helper: {msg['error']}")
+        return msg
+
+    def ns(self, ns_name):
+        return None if ns_name == self.root_ns else ns_name
+
+    async def exec(self, ns_name, cmd: str, input=None):
+        req = {"op": "exec", "ns": self.ns(ns_name), "cmd": cmd}
+        if input is not None:
+            input = input if isinstance(input, bytes) else b"".join(input)
+            req["input"] = base64.b64encode(input).decode()
+        msg = await self.request(req)
+        return subprocess.CompletedProcess(cmd, msg["returncode"], base64.b64decode(msg["stdout"]),
+                                           base64.b64decode(msg["stderr"]))
+
+    # apply_ip returns the error of each line like `mesh.IPCmdBackend.apply`
+    async def apply_ip(self, ns_name, lines: list):
+        msg = await self.request({"op": "ip", "ns": self.ns(ns_name), "lines": lines})
+        return msg["errs"]
+
+    async def close(self):
+        if self.p is None:
+            return
+        self.p.stdin.close()
+        await self.p.wait()
+        await self.reader
+        self.p = None
+
+
+if __name__ == "__main__":
+    serve(sys.stdin.buffer, sys.stdout.buffer)
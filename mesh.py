@@ -1,21 +1,94 @@
+import base64
+import collections
+import concurrent.futures
+import hashlib
+import heapq
+import helper
+import ipaddress
 import json
+import netlink
 import os
-import requests
+import runner
+import select
+import socket
+import struct
 import subprocess
 import sys
-import tempfile
 import threading
 import time
 import typing
 
 
+try:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives import serialization
+except ImportError:
+    X25519PrivateKey = None
+
+
+def clamp_key(k: bytes):
+    k = bytearray(k)
+    k[0] &= 248
+    k[31] &= 127
+    k[31] |= 64
+    return bytes(k)
+
+
+# the same as `wg genkey`
+def genkey():
+    return base64.b64encode(clamp_key(os.urandom(32))).decode()
+
+
+# the same as `wg pubkey`
+def pubkey(sk: str):
+    if X25519PrivateKey is None:
+        # `cryptography` is not installed, see requirements.txt
+        return subprocess.run(["wg", "pubkey"], input=sk.encode(), stdout=subprocess.PIPE, check=True).stdout.decode().strip()
+    pk = X25519PrivateKey.from_private_bytes(base64.b64decode(sk)).public_key().public_bytes(
+        serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+    return base64.b64encode(pk).decode()
+
+
+def genkey_pair():
+    sk = genkey()
+    return sk, pubkey(sk)
+
+
 class Key(object):
-    def __init__(self, key_path):
-        if key_path:
-            self.load(key_path)
-        else:
-            self.sk = subprocess.getoutput("wg genkey")
-            self.pk = subprocess.getoutput("echo '%s' | wg pubkey" % self.sk)
+    def __init__(self, key_path, sk=None, pk=None):
+        """
+        The key is loaded or generated on the first access of `sk` or `pk`,
+        so defining a network does not touch the keys that are not used.
+        """
+        self.key_path = key_path
+        self._sk = sk
+        self._pk = pk
+
+    @staticmethod
+    def gen_many(n: int):
+        """
+        Generates `n` keys in process, which takes microseconds per key with `cryptography`.
+        """
+        return [Key(None, *genkey_pair()) for _ in range(n)]
+
+    def resolve(self):
+        if self._sk is None:
+            if self.key_path:
+                self.load(self.key_path)
+            else:
+                self._sk, self._pk = genkey_pair()
+        elif self._pk is None:
+            self._pk = pubkey(self._sk)
+
+    @property
+    def sk(self):
+        self.resolve()
+        return self._sk
+
+    @property
+    def pk(self):
+        self.resolve()
+        return self._pk
 
     def __str__(self):
         return "<PubKey: %s, PriKey: ******>" % self.pk
@@ -27,8 +100,8 @@ class Key(object):
     def load(self, path):
         with open(path) as f:
             j = json.loads(f.read())
-            self.pk = j["pk"]
-            self.sk = j["sk"]
+            self._pk = j["pk"]
+            self._sk = j["sk"]
 
 
 class NS(object):
@@ -38,103 +111,233 @@ class NS(object):
     def gen_cmd(self, cmd):
         if self.ns_name == "__global_ns":
             return f"sudo {cmd}"
+        elif cmd.startswith("ip "):
+            # `ip -n` enters the namespace by itself, which saves forking `ip netns exec`
+            return f"sudo ip -n {self.ns_name} {cmd[3:]}"
         else:
             return f"sudo ip netns exec {self.ns_name} {cmd}"
 
+    def gen_ip_cmd(self, args):
+        return self.gen_cmd(f"ip {args}")
+
+    # run runs the command in the namespace by `command_runner`, see `runner.Runner.run`
+    def run(self, cmd, input=None, check=True):
+        return command_runner.run(self.ns_name, cmd, input, check)
+
+    def run_ip(self, args, input=None, check=True):
+        return self.run(f"ip {args}", input, check)
+
+    def ip_up_lines(self):
+        if self.ns_name == "__global_ns":
+            return []
+        return [(PHASE_NS, global_ns, f"netns add {self.ns_name}")]
+
+    def ip_down_lines(self):
+        if self.ns_name == "__global_ns":
+            return []
+        return [(PHASE_NS, global_ns, f"netns del {self.ns_name}")]
+
     def up(self):
-        if self.ns_name != "__global_ns":
-            assert(os.system(f"sudo ip netns add {self.ns_name}") == 0)
+        run_ip_lines(self.ip_up_lines())
 
     def down(self):
-        if self.ns_name != "__global_ns":
-            assert(os.system(f"sudo ip netns del {self.ns_name}") == 0)
+        run_ip_lines(self.ip_down_lines())
 
 
+# command_runner runs the commands of all configs, the commands of a namespace are applied in order
+command_runner = runner.Runner(wrap=lambda ns, cmd: NS(ns).gen_cmd(cmd))
+
 global_ns = NS("__global_ns")
 
 
+# The `ip` commands are compiled into one `ip -batch` per (phase, namespace), see `ConfSet.compile`.
+# The phases are applied in order, so a line can depend on any line of the earlier phases.
+PHASE_NS = 0 # create namespaces
+PHASE_LINK = 1 # create links
+PHASE_ADDR = 2 # configure links
+PHASE_ROUTE = 3 # routes and rules
+IP_PHASES = (PHASE_NS, PHASE_LINK, PHASE_ADDR, PHASE_ROUTE)
+
+
+# run_ip_lines runs the lines generated by `ip_up_lines` or `ip_down_lines` one by one
+def run_ip_lines(lines):
+    for _, ns, line in lines:
+        ns.run_ip(line)
+
+
 class Veth(object):
     def __init__(self, name, left_addr, right_addr, left_ns, right_ns):
-        self.up_cmds = [
-            left_ns.gen_cmd(
-                f"ip link add {name}-left type veth peer name {name}-right"),
-            left_ns.gen_cmd(
-                f"ip link set {name}-right netns {right_ns.ns_name}"),
-            left_ns.gen_cmd(f"ip link set {name}-left up"),
-            left_ns.gen_cmd(f"ip addr add {left_addr} dev {name}-left"),
-
-            right_ns.gen_cmd(f"ip link set {name}-right up"),
-            right_ns.gen_cmd(f"ip addr add {right_addr} dev {name}-right"),
+        self.up_lines = [
+            # create the right end in `right_ns` directly
+            (PHASE_LINK, left_ns, f"link add {name}-left type veth peer name {name}-right netns {right_ns.ns_name}"),
+            (PHASE_ADDR, left_ns, f"link set {name}-left up"),
+            (PHASE_ADDR, left_ns, f"addr add {left_addr} dev {name}-left"),
+
+            (PHASE_ADDR, right_ns, f"link set {name}-right up"),
+            (PHASE_ADDR, right_ns, f"addr add {right_addr} dev {name}-right"),
         ]
 
-        self.down_cmds = [
+        self.down_lines = [
             # delete one is enough
-            left_ns.gen_cmd(f"ip link del {name}-left"),
+            (PHASE_LINK, left_ns, f"link del {name}-left"),
         ]
 
+    def ip_up_lines(self):
+        return self.up_lines
+
+    def ip_down_lines(self):
+        return self.down_lines
+
     def up(self):
-        for c in self.up_cmds:
-            assert(os.system(c) == 0)
+        run_ip_lines(self.up_lines)
 
     def down(self):
-        for c in self.down_cmds:
-            assert(os.system(c) == 0)
+        run_ip_lines(self.down_lines)
+
+
+# gen_wg_conf generates the config read by `wg setconf`, `peers` is [(pk, endpoint, allowed_ips)]
+def gen_wg_conf(sk: str, port: typing.Union[int, None], peers: list):
+    # the encrypted wireguard traffic will be marked with 51820
+    conf = f"[Interface]\nPrivateKey = {sk}\nFwMark = 51820\n"
+    if port:
+        conf += f"ListenPort = {port}\n"
+    for pk, endpoint, allowed_ips in peers:
+        conf += f"\n[Peer]\nPublicKey = {pk}\n"
+        if endpoint:
+            conf += f"Endpoint = {endpoint}\n"
+        conf += f"AllowedIPs = {', '.join(allowed_ips)}\nPersistentKeepalive = 30\n"
+    return conf
+
+
+# wg_setconf configures the interface by one `wg` command, the config (with the private key) is passed by a pipe.
+# `sync` only changes the peers which differ (`wg syncconf`), so the sessions of the other peers are kept.
+def wg_setconf(ns: NS, name: str, conf: str, sync: bool = False):
+    ns.run(f"wg {'syncconf' if sync else 'setconf'} {name} /dev/stdin", input=conf.encode())
 
 
 class Wg(object):
     def __init__(self, is_right: bool, name: str, left_key: Key, right_key: Key, addr: str,
                  right_wan_ip: str, port: int, mtu: int, ns: NS):
+        self.is_right = is_right
         self.name = name
+        self.left_key = left_key
+        self.right_key = right_key
+        self.right_wan_ip = right_wan_ip
         self.ns = ns
         self.addr = addr
         self.port = port
 
-        self.tmp_dir = tempfile.mkdtemp()
-        sk_p = os.path.join(self.tmp_dir, "sk")
-        with open(sk_p, "w") as f:
-            if is_right:
-                f.write(right_key.sk)
-            else:
-                f.write(left_key.sk)
-
-        self.up_cmds = [
-            ns.gen_cmd(f"ip link add dev {name} type wireguard"),
-            ns.gen_cmd(f"ip address add dev {name} {addr}"),
-            ns.gen_cmd(f"ip link set mtu {mtu} dev {name}"),
-            # the encrypted wireguard traffic will be marked with 51820
-            ns.gen_cmd(f"wg set {name} fwmark 51820"),
+        self.up_lines = [
+            (PHASE_LINK, ns, f"link add dev {name} type wireguard"),
+            (PHASE_ADDR, ns, f"address add dev {name} {addr}"),
+            (PHASE_ADDR, ns, f"link set mtu {mtu} dev {name}"),
+            (PHASE_ADDR, ns, f"link set up dev {name}"),
         ]
+        self.down_lines = [(PHASE_LINK, ns, f"link del {name}")]
 
-        if is_right:
-            self.up_cmds.append(
-                ns.gen_cmd(f"wg set {name} listen-port {port} private-key {sk_p}"
-                           + f" peer {left_key.pk} allowed-ips 0.0.0.0/0 persistent-keepalive 30")
-            )
-        else:
-            self.up_cmds.append(
-                ns.gen_cmd(f"wg set {name} private-key {sk_p}"
-                           + f" peer {right_key.pk} endpoint {right_wan_ip}:{port}"
-                           + f" allowed-ips 0.0.0.0/0  persistent-keepalive 30")
-            )
+    def ip_up_lines(self):
+        return self.up_lines
+
+    def ip_down_lines(self):
+        return self.down_lines
+
+    # the keys are only read here, when the link is brought up
+    def gen_conf(self):
+        if self.is_right:
+            return gen_wg_conf(self.right_key.sk, self.port, [(self.left_key.pk, None, ["0.0.0.0/0"])])
+        endpoint = f"{self.right_wan_ip}:{self.port}"
+        return gen_wg_conf(self.left_key.sk, None, [(self.right_key.pk, endpoint, ["0.0.0.0/0"])])
+
+    # configure the wireguard part of the link, which can not be done by `ip`
+    def configure(self):
+        wg_setconf(self.ns, self.name, self.gen_conf())
+
+    # diff updates the live link in place if only the wireguard part changed, see `diff_confs`
+    def diff(self, old):
+        if [l for _, _, l in old.up_lines] != [l for _, _, l in self.up_lines]:
+            return None
+        return [], [Update(lambda: wg_setconf(self.ns, self.name, self.gen_conf(), sync=True), self.ns)]
+
+    def up(self):
+        run_ip_lines(self.up_lines)
+        self.configure()
+
+    def down(self):
+        run_ip_lines(self.down_lines)
+
+
+# WgIface is the only wireguard interface of a host, which holds all its peers, see `Network(single_interface=True)`.
+# The peers are chosen by the destination of a packet, so each peer is allowed the addresses routed through it.
+class WgIface(object):
+    name = "wg-mesh"
 
-        self.up_cmds.append(ns.gen_cmd(f"ip link set up dev {name}"))
-        self.down_cmd = ns.gen_cmd(f"ip link del {name}")
+    def __init__(self, key: Key, port: typing.Union[int, None], mtu: int, ns: NS):
+        self.key = key
+        self.port = port
+        self.mtu = mtu
+        self.ns = ns
+        self.addrs = []
+        self.peers = {} # tunnel ip of the peer -> [key, endpoint, allowed_ips]
+
+    def add_peer(self, addr: str, peer_ip: str, key: Key, endpoint: typing.Union[str, None]):
+        self.addrs.append(addr)
+        self.peers[peer_ip] = [key, endpoint, []]
+
+    def ip_up_lines(self):
+        name = self.name
+        return [(PHASE_LINK, self.ns, f"link add dev {name} type wireguard")] + \
+            [(PHASE_ADDR, self.ns, f"address add dev {name} {addr}") for addr in self.addrs] + [
+            (PHASE_ADDR, self.ns, f"link set mtu {self.mtu} dev {name}"),
+            (PHASE_ADDR, self.ns, f"link set up dev {name}"),
+        ]
+
+    def ip_down_lines(self):
+        return [(PHASE_LINK, self.ns, f"link del {self.name}")]
 
-    def __del__(self):
-        assert(os.system(f"rm -r {self.tmp_dir}") == 0)
+    def gen_conf(self):
+        peers = [(key.pk, endpoint, allowed_ips) for key, endpoint, allowed_ips in self.peers.values()]
+        return gen_wg_conf(self.key.sk, self.port, peers)
+
+    def configure(self):
+        wg_setconf(self.ns, self.name, self.gen_conf())
+
+    # diff updates the addresses and the peers of the live interface, the unchanged peers keep their sessions
+    def diff(self, old):
+        if self.mtu != old.mtu:
+            return None
+        lines = [(PHASE_ADDR, self.ns, f"address del dev {self.name} {a}") for a in old.addrs if a not in self.addrs]
+        lines += [(PHASE_ADDR, self.ns, f"address add dev {self.name} {a}") for a in self.addrs if a not in old.addrs]
+        def update():
+            run_ip_lines(lines)
+            wg_setconf(self.ns, self.name, self.gen_conf(), sync=True)
+        return [], [Update(update, self.ns)]
 
     def up(self):
-        for c in self.up_cmds:
-            assert(os.system(c) == 0)
+        run_ip_lines(self.ip_up_lines())
+        self.configure()
 
     def down(self):
-        assert(os.system(self.down_cmd) == 0)
+        run_ip_lines(self.ip_down_lines())
+
+
+# WgConf is the part of `Wg` left after the `ip` commands are compiled into batches
+class WgConf(object):
+    def __init__(self, wg: Wg):
+        self.wg = wg
+        self.ns = wg.ns
+
+    def up(self):
+        self.wg.configure()
+
+    def down(self):
+        # the configuration is removed together with the link
+        pass
 
 
 # `link_cidr` should be `/30`, namely, the last digit of ip is the multiple of 4
 # Suppose the `link_cidr="192.10.1.0/30", then the `left_ip` will be `192.10.1.1`,
 # the `right_ip` will be `192.10.1.2`.
-def gen_wg(name, left_key, right_key, right_wan_ip, link_cidr, port, mtu, left_ns, right_ns):
+def link_addrs(link_cidr):
     # check if the last digit is the multiple of 4
     assert(link_cidr.endswith("/30"))
     abcd = link_cidr[:-3]
@@ -142,8 +345,11 @@ def gen_wg(name, left_key, right_key, right_wan_ip, link_cidr, port, mtu, left_n
     d = int(abcd.split(".")[-1])
     assert(d % 4 == 0)
 
-    left_ip = f"{abc}.{d+1}/30"
-    right_ip = f"{abc}.{d+2}/30"
+    return f"{abc}.{d+1}/30", f"{abc}.{d+2}/30"
+
+
+def gen_wg(name, left_key, right_key, right_wan_ip, link_cidr, port, mtu, left_ns, right_ns):
+    left_ip, right_ip = link_addrs(link_cidr)
 
     left = Wg(False, name, left_key, right_key, left_ip,
               right_wan_ip, int(port), int(mtu), left_ns)
@@ -155,65 +361,501 @@ def gen_wg(name, left_key, right_key, right_wan_ip, link_cidr, port, mtu, left_n
 
 class IPTableRule(object):
     def __init__(self, table, chain, rule, ns: NS):
-        self.up_cmd = ns.gen_cmd(f"iptables -t {table} -A {chain} {rule}")
-        self.down_cmd = ns.gen_cmd(f"iptables -t {table} -D {chain} {rule}")
+        self.table = table
+        self.chain = chain
+        self.rule = rule
+        self.ns = ns
 
     def up(self):
-        #print(f"+ {self.up_cmd}")
-        assert(os.system(self.up_cmd) == 0)
+        self.ns.run(f"iptables -t {self.table} -A {self.chain} {self.rule}")
 
     def down(self):
-        assert(os.system(self.down_cmd) == 0)
+        self.ns.run(f"iptables -t {self.table} -D {self.chain} {self.rule}")
+
+
+# IPTableBatch applies all the rules of one namespace by a single `iptables-restore --noflush`.
+# Each table is committed as its own transaction, so a table gets all of its rules or none of them, but if a table
+# fails, the tables committed before it keep their rules.
+class IPTableBatch(object):
+    def __init__(self, ns: NS):
+        self.ns = ns
+        self.rules = []
+
+    def add(self, rule: IPTableRule):
+        assert(rule.ns.ns_name == self.ns.ns_name)
+        self.rules.append(rule)
+
+    def gen_restore_txt(self, op: str, rules: list, ops: list = ()):
+        """
+        `ops` are more (op, rules) applied after `rules`, the ops of a table are committed together.
+        """
+        tables = {}
+        for op, rules in [(op, rules)] + list(ops):
+            for r in rules:
+                tables.setdefault(r.table, []).append(f"{op} {r.chain} {r.rule}")
+
+        txt = ""
+        for table, lines in tables.items():
+            txt += f"*{table}\n"
+            txt += "\n".join(lines) + "\n"
+            txt += "COMMIT\n"
+        return txt
+
+    def restore(self, txt: str):
+        self.ns.run("iptables-restore --noflush", input=txt.encode())
+
+    def up(self):
+        self.restore(self.gen_restore_txt("-A", self.rules))
+
+    def down(self):
+        self.restore(self.gen_restore_txt("-D", self.rules[::-1]))
+
+    # replace swaps the live rules of `old` with the rules of this batch, a table never misses its rules
+    def replace(self, old):
+        self.restore(self.gen_restore_txt("-D", old.rules[::-1], [("-A", self.rules)]))
 
 
 class Route(object):
     def __init__(self, addr, via, table, ns: NS):
-        self.up_cmd = ns.gen_cmd(f"ip route add {addr} via {via} table {table}")
-        self.down_cmd = ns.gen_cmd(f"ip route del {addr} via {via} table {table}")
+        self.up_lines = [(PHASE_ROUTE, ns, f"route add {addr} via {via} table {table}")]
+        self.down_lines = [(PHASE_ROUTE, ns, f"route del {addr} via {via} table {table}")]
+
+    def ip_up_lines(self):
+        return self.up_lines
+
+    def ip_down_lines(self):
+        return self.down_lines
 
     def up(self):
-        #print(f"+ {self.up_cmd}")
-        assert(os.system(self.up_cmd) == 0)
+        run_ip_lines(self.up_lines)
 
     def down(self):
-        assert(os.system(self.down_cmd) == 0)
+        run_ip_lines(self.down_lines)
+
+# Routes is a routing table of a host, namely the routes to many cidrs through a few next hops.
+# It keeps references to the cidr lists claimed by the hosts instead of a `Route` per cidr,
+# so the static routes of a large mesh take a pointer per (host, destination host).
+class Routes(object):
+    def __init__(self, table, ns: NS):
+        self.table = table
+        self.ns = ns
+        self.via = {} # next_hop -> List[List[cidr]]
+
+    def add(self, cidrs: list, via: str):
+        self.via.setdefault(via, []).append(cidrs)
+
+    def __len__(self):
+        return sum(1 for _ in self.routes())
+
+    def routes(self):
+        for via, cidrs_list in self.via.items():
+            for cidrs in cidrs_list:
+                for cidr in cidrs:
+                    # the next hop itself is directly connected
+                    if cidr != via:
+                        yield cidr, via
+
+    def ip_up_lines(self):
+        return [(PHASE_ROUTE, self.ns, f"route add {cidr} via {via} table {self.table}") for cidr, via in self.routes()]
+
+    def ip_down_lines(self):
+        return [(PHASE_ROUTE, self.ns, f"route del {cidr} via {via} table {self.table}") for cidr, via in self.routes()]
+
+    def diff_key(self):
+        return ("Routes", self.ns.ns_name, self.table), set(self.routes())
+
+    # diff returns the tables of the routes to delete and to add, the other routes are untouched
+    def diff(self, old):
+        old_routes, new_routes = set(old.routes()), set(self.routes())
+        removed, added = Routes(self.table, self.ns), Routes(self.table, self.ns)
+        for cidr, via in old_routes - new_routes:
+            removed.add([cidr], via)
+        for cidr, via in new_routes - old_routes:
+            added.add([cidr], via)
+        return [r for r in [removed] if len(r.via) > 0], [r for r in [added] if len(r.via) > 0]
+
+    def up(self):
+        run_ip_lines(self.ip_up_lines())
+
+    def down(self):
+        run_ip_lines(self.ip_down_lines())
+
+def claimed_prefixes(hosts: list, links: list):
+    """
+    Returns the IPv4 cidrs claimed by `hosts` as [(net, plen, owner, fixed)] sorted by address, where `owner` is the
+    index of the claiming host, and the other cidrs as [(cidr, owner)].
+    The network and broadcast addresses of the link `/30`s are added with owner -1, as nothing is routed to them.
+    A cidr overlapping another one is `fixed`, namely it is never merged by `summarize_routes`.
+    """
+    prefixes = []
+    others = []
+    for owner, h in enumerate(hosts):
+        for cidr in h.lan_cidrs:
+            addr, _, plen = cidr.partition("/")
+            plen = int(plen) if plen else 32
+            try:
+                net = int.from_bytes(socket.inet_pton(socket.AF_INET, addr), "big")
+            except OSError:
+                others.append((cidr, owner))
+                continue
+            mask = (0xffffffff << (32 - plen)) & 0xffffffff
+            prefixes.append([net & mask, plen, owner, False])
+    for _, _, cidr, _ in links:
+        net = int.from_bytes(socket.inet_pton(socket.AF_INET, cidr.split("/")[0]), "big")
+        prefixes += [[net, 32, -1, False], [net + 3, 32, -1, False]]
+
+    prefixes.sort()
+    end = -1
+    last = None
+    for p in prefixes:
+        if p[0] <= end:
+            p[3] = last[3] = True
+        if p[0] + (1 << (32 - p[1])) - 1 > end:
+            end = p[0] + (1 << (32 - p[1])) - 1
+            last = p
+    return [tuple(p) for p in prefixes], others
+
+
+def summarize_routes(prefixes: list, labels: list):
+    """
+    Summarizes the routes to `prefixes` (see `claimed_prefixes`) into the fewest covering prefixes,
+    where `labels[owner]` is the next hop towards the owner, None if it does not matter (e.g. the addresses of the
+    host itself) and False if it must not be covered (e.g. an unreachable host).
+    Two sibling prefixes are merged if their next hops are the same or one does not matter, so every claimed
+    address keeps its next hop. Returns [(net, plen, next_hop, fixed)], where next_hop may be None or False.
+    """
+    stack = [] # [(net, plen, label, fixed)], every prefix in the stack is after the ones below it
+    for net, plen, owner, fixed in prefixes:
+        label = labels[owner]
+        # merges the prefix with its lower sibling on the top of the stack, then its parent, and so on
+        while stack and not fixed:
+            n, p, l, f = stack[-1]
+            bit = 1 << (32 - plen)
+            if f or p != plen or plen == 0 or n & bit or net != n | bit:
+                break
+            if l is False or label is False or (l != label and l is not None and label is not None):
+                break
+            stack.pop()
+            net, plen, label = n, plen - 1, l if l is not None else label
+        stack.append((net, plen, label, fixed))
+    return stack
+
 
 class RouteRule(object):
     def __init__(self, mark, table, ns: NS):
         self.mark = mark
         self.table = table
         self.ns = ns
-    
+
+    def ip_up_lines(self):
+        return [(PHASE_ROUTE, self.ns, f"rule add fwmark {self.mark} table {self.table}")]
+
+    def ip_down_lines(self):
+        return [(PHASE_ROUTE, self.ns, f"rule del fwmark {self.mark} table {self.table}")]
+
     def up(self):
-        assert(os.system(self.ns.gen_cmd(f"ip rule add fwmark {self.mark} table {self.table}")) == 0)
-    
+        run_ip_lines(self.ip_up_lines())
+
+    def down(self):
+        run_ip_lines(self.ip_down_lines())
+
+
+class IPBatchError(Exception):
+    def __init__(self, ns: NS, lineno: int, line: str, err: str, applied):
+        super().__init__(f"ip -batch in {ns.ns_name} failed at line {lineno}: {line}: {err}")
+        self.lineno = lineno
+        self.line = line
+        # `applied` is an `IPBatch` of the configs whose lines are all applied, which should be rolled back
+        self.applied = applied
+
+
+# IPCmdBackend applies the `ip` lines of a namespace by a single `ip -batch -`
+class IPCmdBackend(object):
+    def apply(self, ns: NS, lines: list):
+        """
+        Returns the error of each line, which is `None` if the line succeeded.
+        `ip -batch` stops at the first failed line, so the lines after it are `netlink.NOT_EXECUTED`.
+        """
+        txt = "".join(l + "\n" for l in lines)
+        p = ns.run_ip("-batch -", input=txt.encode(), check=False)
+        if p.returncode == 0:
+            return [None] * len(lines)
+
+        err = p.stderr.decode()
+        sys.stderr.write(err)
+        # ip reports the failed line as "Command failed -:LINENO" following the error message
+        lineno = len(lines)
+        msg = err.strip()
+        err_lines = err.splitlines()
+        for i, l in enumerate(err_lines):
+            if l.startswith("Command failed -:"):
+                lineno = int(l[len("Command failed -:"):])
+                if i > 0:
+                    msg = err_lines[i - 1]
+                break
+        return [None] * (lineno - 1) + [msg] + [netlink.NOT_EXECUTED] * (len(lines) - lineno)
+
+
+# NetlinkBackend applies the `ip` lines in process through rtnetlink, see `netlink.py`.
+# Namespaces are not managed by rtnetlink, so their lines fall back to `ip`.
+# It requires running as root rather than through `sudo`.
+class NetlinkBackend(object):
+    def __init__(self):
+        self.fallback = IPCmdBackend()
+
+    def apply(self, ns: NS, lines: list):
+        if any(l.startswith("netns ") for l in lines):
+            return self.fallback.apply(ns, lines)
+
+        # a new socket each time, a cached one would keep deleted namespaces alive
+        ns_name = None if ns.ns_name == "__global_ns" else ns.ns_name
+        with netlink.Netlink(ns_name) as nl:
+            return nl.apply(lines)
+
+
+# HelperBackend applies the `ip` lines in the privileged helper of `command_runner`, see `helper.py`.
+# The helper talks rtnetlink from a thread staying in the namespace, so no process is spawned.
+class HelperBackend(object):
+    def apply(self, ns: NS, lines: list):
+        return command_runner.apply_ip(ns.ns_name, lines)
+
+
+# IPBatch applies all the `ip` lines of one phase in one namespace at once by the `ip_backend`
+class IPBatch(object):
+    def __init__(self, phase: int, ns: NS, ip_backend=None):
+        self.phase = phase
+        self.ns = ns
+        self.ip_backend = ip_backend if ip_backend else IPCmdBackend()
+        self.confs = []
+
+    def add(self, c):
+        self.confs.append(c)
+
+    def lines(self, conf, up: bool):
+        lines = conf.ip_up_lines() if up else conf.ip_down_lines()
+        return [l for phase, ns, l in lines if phase == self.phase and ns.ns_name == self.ns.ns_name]
+
+    def run(self, confs, up: bool):
+        owners = []
+        lines = []
+        for c in confs:
+            for l in self.lines(c, up):
+                owners.append(c)
+                lines.append(l)
+        if len(lines) == 0:
+            return
+
+        errs = self.ip_backend.apply(self.ns, lines)
+        failed = [i for i, e in enumerate(errs) if e != None]
+        if len(failed) == 0:
+            return
+
+        applied = IPBatch(self.phase, self.ns, self.ip_backend)
+        failed_owners = [owners[i] for i in failed]
+        for c in confs:
+            if all(c is not o for o in failed_owners):
+                applied.add(c)
+        i = failed[0]
+        raise IPBatchError(self.ns, i + 1, lines[i], errs[i], applied)
+
+    def up(self):
+        self.run(self.confs, True)
+
     def down(self):
-        assert(os.system(self.ns.gen_cmd(f"ip rule del fwmark {self.mark} table {self.table}")) == 0)
+        self.run(self.confs[::-1], False)
+
 
 class IPSet(object):
-    def __init__(self, name: str, ips: list, ns: typing.Union[NS, None] = None):
+    def __init__(self, name: str, ips: typing.Union[list, typing.Callable[[], list]], ns: typing.Union[NS, None] = None):
         """
-        `ns` can be `None` when defining a dummy ipset used in `Network` which will assign the proper namespace to it
+        `ns` can be `None` when defining a dummy ipset used in `Network` which will assign the proper namespace to it.
+        `ips` can be a function returning the list (e.g. `chinaip_list`), which is called when the ips are needed.
         """
         self.name = name
         self.ns = ns
-        self.ips = ips
+        self.ips_source = ips
+        self._ips = None
 
-        self.ipset_txt = ""
-        for ip in self.ips:
-            self.ipset_txt += f"add {name} {ip}\n"
+    @property
+    def ips(self):
+        if self._ips is None:
+            self._ips = self.ips_source() if callable(self.ips_source) else self.ips_source
+        return self._ips
 
-    def up(self):
+    def gen_create_opts(self):
+        """
+        Sizes the set from its contents instead of using the kernel defaults (hashsize 1024, maxelem 65536),
+        so loading a large list does not resize the hash table repeatedly or hit maxelem.
+        """
+        ips = self.ips
+        families = set("inet6" if ":" in ip else "inet" for ip in ips)
+        assert(len(families) <= 1) # a hash:net set holds either IPv4 or IPv6 prefixes
+        family = families.pop() if families else "inet"
+
+        # one bucket per entry on average, the kernel rounds it to the power of 2
+        hashsize = max(1024, len(ips))
+        # leave room for refreshing the set with a longer list
+        maxelem = max(65536, 2 * len(ips))
+        return f"family {family} hashsize {hashsize} maxelem {maxelem}"
+
+    # gen_restore_chunks yields the `ipset restore` input piece by piece, the whole text is never built
+    def gen_restore_chunks(self, name=None, create=True, chunk_size=1024):
+        name = name if name else self.name
+        if create:
+            yield f"create {name} hash:net {self.gen_create_opts()}\n".encode()
+        ips = self.ips
+        for i in range(0, len(ips), chunk_size):
+            yield "".join(f"add {name} {ip}\n" for ip in ips[i:i + chunk_size]).encode()
+
+    def restore(self, chunks):
         assert(self.ns != None)
-        assert(os.system(self.ns.gen_cmd(f"ipset create {self.name} hash:net")) == 0)
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            p = os.path.join(tmp_dir, "ipset.txt")
-            with open(p, "w") as f:
-                f.write(self.ipset_txt)
-            assert(os.system(self.ns.gen_cmd(f"ipset restore < {p}")) == 0)
+        self.ns.run("ipset restore", input=chunks)
+
+    def up(self):
+        self.restore(self.gen_restore_chunks())
+
+    def stat(self):
+        """
+        Returns the header of `ipset list -t`, e.g. {"Size in memory": "10472", "Number of entries": "5916", ...}.
+        """
+        p = self.ns.run(f"ipset list -t {self.name}")
+        stat = {}
+        for l in p.stdout.decode().splitlines():
+            k, _, v = l.partition(":")
+            stat[k.strip()] = v.strip()
+        return stat
+
+    def report(self):
+        """
+        Returns the size of the live set as {"entries", "prefix_lengths", "memory", "header"}, or `None` if the
+        commands are not run (see `Network.plan`).
+        hash:net looks up every distinct prefix length, so `prefix_lengths` is the number of hash lookups per packet.
+        """
+        stat = self.stat()
+        if len(stat) == 0:
+            return None
+        plens = set(ip.split("/")[1] if "/" in ip else "32" for ip in self.ips)
+        return {"entries": int(stat.get("Number of entries", 0)), "prefix_lengths": len(plens),
+                "memory": int(stat.get("Size in memory", 0)), "header": stat.get("Header")}
+
+    def refresh_source(self, ips=None):
+        if ips is not None:
+            self.ips_source = ips
+        self._ips = None
+
+    def refresh(self, ips=None):
+        """
+        Reloads the contents of the live set, e.g. after `china_ip_list.txt` is updated.
+        The new contents are loaded into a temporary set which is swapped with the live one atomically,
+        so the rules matching the set never see it empty or half loaded.
+        `ips` replaces the source of the set, otherwise the source is loaded again.
+        """
+        self.refresh_source(ips)
+
+        # ipset names are at most 31 characters
+        tmp = f"{self.name[:27]}-new"
+        # a temporary set left by an interrupted refresh may be sized differently, so it cannot be reused
+        self.destroy_if_exists(tmp)
+        def chunks():
+            yield from self.gen_restore_chunks(tmp)
+            yield f"swap {tmp} {self.name}\ndestroy {tmp}\n".encode()
+        try:
+            self.restore(chunks())
+        except Exception:
+            self.destroy_if_exists(tmp)
+            raise
+
+    def destroy_if_exists(self, name: str):
+        p = self.ns.run(f"ipset destroy {name}", check=False)
+        if p.returncode != 0 and b"does not exist" not in p.stderr:
+            raise runner.CommandError(self.ns.ns_name, p)
 
     def down(self):
-        assert(os.system(self.ns.gen_cmd(f"ipset destroy {self.name}")) == 0)
+        self.ns.run(f"ipset destroy {self.name}")
+
+    def diff_key(self):
+        return ("IPSet", self.ns.ns_name, self.name), tuple(self.ips)
+
+    def diff(self, old):
+        return [], [Update(lambda: self.refresh(self.ips), self.ns)]
+
+
+# collapse_cidrs merges the adjacent and overlapping prefixes, the covered addresses stay the same
+def collapse_cidrs(cidrs: list):
+    nets = {4: [], 6: []}
+    for c in cidrs:
+        n = ipaddress.ip_network(c, strict=False)
+        nets[n.version].append(n)
+    return [str(n) for v in (4, 6) for n in ipaddress.collapse_addresses(nets[v])]
+
+
+CIDR_CACHE_MAGIC = b"wg-mesh cidr cache v1\n"
+
+
+# The cache stores the numbers of IPv4 and IPv6 prefixes, then 5 bytes for each IPv4 prefix (4 bytes address and
+# 1 byte length) followed by 17 bytes for each IPv6 prefix, so that it can be decoded by `struct.iter_unpack` at once.
+def encode_cidr_cache(digest: bytes, cidrs: list):
+    v4 = []
+    v6 = []
+    for c in cidrs:
+        addr, plen = c.split("/")
+        if ":" in addr:
+            v6.append(socket.inet_pton(socket.AF_INET6, addr) + bytes([int(plen)]))
+        else:
+            v4.append(socket.inet_pton(socket.AF_INET, addr) + bytes([int(plen)]))
+    return b"".join([CIDR_CACHE_MAGIC, digest, struct.pack("II", len(v4), len(v6))] + v4 + v6)
+
+
+# decode_cidr_cache returns None if the data is truncated
+def decode_cidr_cache(data: bytes):
+    if len(data) < 8:
+        return None
+    n4, n6 = struct.unpack("II", data[:8])
+    end4 = 8 + 5 * n4
+    if end4 + 17 * n6 != len(data):
+        return None
+    cidrs = [f"{a}.{b}.{c}.{d}/{l}" for a, b, c, d, l in struct.iter_unpack("BBBBB", data[8:end4])]
+    for i in range(end4, len(data), 17):
+        cidrs.append(f"{socket.inet_ntop(socket.AF_INET6, data[i:i + 16])}/{data[i + 16]}")
+    return cidrs
+
+
+def load_cidr_file(path: str):
+    """
+    Loads the prefixes listed in `path` and collapses them by `collapse_cidrs`.
+    The result is cached in a compact binary file next to it (`path` + ".cache"), keyed by the sha256 of the source,
+    so the source is only parsed again after it changes.
+    """
+    with open(path, "rb") as f:
+        src = f.read()
+    digest = hashlib.sha256(src).digest()
+    cache_path = path + ".cache"
+    header = CIDR_CACHE_MAGIC + digest
+
+    try:
+        with open(cache_path, "rb") as f:
+            cache = f.read()
+        if cache.startswith(header):
+            cidrs = decode_cidr_cache(cache[len(header):])
+            if cidrs is not None:
+                return cidrs
+    except OSError:
+        pass
+
+    cidrs = collapse_cidrs(src.decode().split())
+    # written aside and renamed, so a crash or a concurrent run never leaves a truncated cache
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(encode_cidr_cache(digest, cidrs))
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # the cache is optional, e.g. the directory may be read only
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return cidrs
 
 
 def chinaip_list():
@@ -221,10 +863,7 @@ def chinaip_list():
         os.path.dirname(os.path.realpath(__file__)),
         "china_ip_list.txt"
     )
-
-    with open(list_path) as f:
-        l = f.read().split()
-        return l
+    return load_cidr_file(list_path)
 
 
 def privateip_list():
@@ -244,41 +883,314 @@ class IPSetBundle(object):
             s += f"-m set ! --match-set {m.name} dst "
         return s.strip()
 
-class AnyProxy(object):
-    def __init__(self, ns: NS):
+    def gen_nft_condition(self):
+        s = ""
+        for m in self.match:
+            s += f"ip daddr @{m.name} "
+        for m in self.not_match:
+            s += f"ip daddr != @{m.name} "
+        return s.strip()
+
+
+class NftRuleset(object):
+    """
+    NftRuleset implements the policy routing of a host (see `Host.policy_route`) as one nftables table,
+    which is loaded atomically by a single `nft -f`.
+    The ipsets become interval sets, and the rules matching the source address are dispatched by verdict maps
+    keyed on the source, so a packet does one map lookup instead of going through the rules of every client.
+    """
+    table = "wgmesh"
+
+    # the base chains, and the hooks they are attached to
+    base_chains = {
+        "output": "type route hook output priority mangle; policy accept;",
+        "prerouting": "type filter hook prerouting priority mangle; policy accept;",
+        "postrouting": "type nat hook postrouting priority srcnat; policy accept;",
+        "nat_prerouting": "type nat hook prerouting priority dstnat; policy accept;",
+    }
+
+    def __init__(self, ipsets: list, policies: list, ns: NS):
+        self.ipsets = ipsets
+        self.policies = policies
         self.ns = ns
-    
-    def exec_anyproxy(self):
-        exe = os.path.join(
-            os.path.dirname(os.path.realpath(__file__)),
-            "bin",
-            "any_proxy",
-        )
-        self.p = subprocess.Popen(self.ns.gen_cmd(exe) + " -l=:3140", shell=True)
 
-    def check(self):
+    def gen_elements(self, ipset: IPSet):
+        return ", ".join(ipset.ips)
+
+    def gen_txt(self):
+        chains = {name: [] for name in self.base_chains}
+        src_chains = {name: {} for name in self.base_chains} # base chain -> src_ip -> rules
+
+        snat = {} # mark -> src_ip
+        for kind, src_ip, ipsetbundle, mark in self.policies:
+            cond = ipsetbundle.gen_nft_condition()
+            if kind == "output":
+                # the same as the iptables rules, see `Host.gen_iptables_rules`
+                chains["output"].append(f"{cond} meta mark 0 ct state != {{ established, related }} ct mark 0 ct mark set {mark}")
+                snat[mark] = src_ip
+            elif kind == "forward":
+                src_chains["prerouting"].setdefault(src_ip, []).append(f"{cond} meta mark 0 meta mark set {mark}")
+            else:
+                src_chains["postrouting"].setdefault(src_ip, []).append(f"{cond} meta mark 0 meta l4proto != tcp masquerade")
+                src_chains["nat_prerouting"].setdefault(src_ip, []).append(f"{cond} meta mark 0 meta l4proto tcp redirect to :3140")
+
+        for mark, src_ip in snat.items():
+            chains["output"].append(f"ct mark {mark} meta mark set {mark}")
+            chains["postrouting"].append(f"ct mark {mark} snat to {src_ip}")
+
+        t = self.table
+        # creating and deleting the table first makes loading the ruleset idempotent
+        txt = f"table ip {t}\ndelete table ip {t}\ntable ip {t} {{\n"
+        for ipset in self.ipsets:
+            txt += f"    set {ipset.name} {{\n        type ipv4_addr\n        flags interval\n        auto-merge\n"
+            if len(ipset.ips) > 0:
+                txt += f"        elements = {{ {self.gen_elements(ipset)} }}\n"
+            txt += "    }\n"
+
+        for name, per_src in src_chains.items():
+            if len(per_src) == 0:
+                continue
+            elements = []
+            for src_ip, rules in per_src.items():
+                chain = f"{name}_" + src_ip.replace(".", "_")
+                elements.append(f"{src_ip} : jump {chain}")
+                txt += f"    chain {chain} {{\n" + "".join(f"        {r.strip()}\n" for r in rules) + "    }\n"
+            txt += f"    map {name}_src {{\n        type ipv4_addr : verdict\n        elements = {{ {', '.join(elements)} }}\n    }}\n"
+            chains[name].append(f"ip saddr vmap @{name}_src")
+
+        for name, rules in chains.items():
+            if len(rules) == 0:
+                continue
+            txt += f"    chain {name} {{\n        {self.base_chains[name]}\n" + "".join(f"        {r.strip()}\n" for r in rules) + "    }\n"
+        txt += "}\n"
+        return txt
+
+    def load(self, txt: str):
+        self.ns.run("nft -f -", input=txt.encode())
+
+    def up(self):
+        self.load(self.gen_txt())
+
+    def down(self):
+        self.ns.run(f"nft delete table ip {self.table}")
+
+    def diff_key(self):
+        return ("NftRuleset", self.ns.ns_name, self.table), self.gen_txt()
+
+    # diff replaces the live table in one transaction, declaring the table first makes the delete always succeed
+    def diff(self, old):
+        txt = f"table ip {self.table} {{}}\ndelete table ip {self.table}\n" + self.gen_txt()
+        return [], [Update(lambda: self.load(txt), self.ns)]
+
+    # refresh reloads the contents of the sets, flushing and filling a set in one transaction is atomic
+    def refresh(self):
+        txt = ""
+        for ipset in self.ipsets:
+            ipset.refresh_source()
+            txt += f"flush set ip {self.table} {ipset.name}\n"
+            if len(ipset.ips) > 0:
+                txt += f"add element ip {self.table} {ipset.name} {{ {self.gen_elements(ipset)} }}\n"
+        self.load(txt)
+
+# listening tells if a socket of `proto` ("tcp" or "udp") is bound to the port in the namespace, by /proc/net
+def listening(ns: NS, proto: str, port: int):
+    files = [f"/proc/net/{proto}", f"/proc/net/{proto}6"]
+    if ns.ns_name == "__global_ns":
+        txt = ""
+        for path in files:
+            if os.path.exists(path):
+                with open(path) as f:
+                    txt += f.read()
+    else:
+        txt = ns.run("cat " + " ".join(files), check=False).stdout.decode()
+
+    for l in txt.splitlines():
+        fields = l.split()
+        if len(fields) < 4 or ":" not in fields[1] or fields[0] == "sl":
+            continue
+        # "0100007F:0C44", the state 0A is LISTEN, an unconnected udp socket is 07
+        if int(fields[1].rsplit(":", 1)[1], 16) == port and fields[3] == ("0A" if proto == "tcp" else "07"):
+            return True
+    return False
+
+
+# Daemon is a long-lived child kept running by `Supervisor`
+class Daemon(object):
+    def __init__(self, name: str, cmd: str, ready: typing.Callable[[], bool], ns: typing.Union[NS, None] = None):
+        """
+        `ready` probes if the daemon is serving, e.g. its socket is bound.
+        `ns` runs the daemon as root in the namespace, otherwise it runs as a plain child.
+        """
+        self.name = name
+        self.cmd = cmd
+        self.ready = ready
+        self.ns = ns
+        self.p = None
+        self.pidfd = None
+        self.started_at = 0
+        self.restarts = 0
+        self.failures = 0 # the restarts in a row without staying up for `Supervisor.stable` seconds
+        self.stopping = False
+        self.restart_at = None
+
+    def spawn(self):
+        # `exec` makes the pid the daemon (or its sudo), which is killed on down
+        cmd = self.ns.gen_cmd(self.cmd) if self.ns else self.cmd
+        self.p = subprocess.Popen(f"exec {cmd}", shell=True)
+        self.pidfd = os.pidfd_open(self.p.pid)
+        self.started_at = time.monotonic()
+
+    def kill(self):
+        if self.ns:
+            global_ns.run(f"kill {self.p.pid}", check=False)
+        else:
+            self.p.terminate()
+
+
+class Supervisor(object):
+    """
+    Supervisor keeps the daemons running. One thread waits on the pidfds of all daemons, so an exit is noticed at
+    once, and the daemon is restarted after a backoff doubling from `min_backoff` up to `max_backoff`.
+    The backoff is reset once a daemon stays up for `stable` seconds, so a crash loop does not spin.
+    pidfds need Linux 5.3, which is older than the wireguard in the kernel.
+    `on_exit(daemon, exit_code, backoff)` is called from the supervisor thread when a daemon exits unexpectedly.
+    """
+    def __init__(self, min_backoff: float = 0.1, max_backoff: float = 30.0, stable: float = 10.0,
+                 on_exit: typing.Union[typing.Callable[[Daemon, int, float], None], None] = None):
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stable = stable
+        self.on_exit = on_exit
+        self.lock = threading.Lock()
+        self.daemons = {} # pidfd -> Daemon, the running ones
+        self.waiting = [] # the daemons to restart
+        self.thread = None
+        self.wake_r, self.wake_w = None, None
+
+    def wake(self):
+        os.write(self.wake_w, b"x")
+
+    def start(self, d: Daemon, timeout: float = 10.0):
+        """
+        Starts the daemon and waits until it is ready, raises `RuntimeError` if it exits or is not ready in time.
+        """
+        if command_runner.records is not None:
+            command_runner.record(d.ns.ns_name if d.ns else None, d.cmd, owner=runner.owner.get(), daemon=True)
+            return
+        with self.lock:
+            if self.thread is None:
+                self.wake_r, self.wake_w = os.pipe()
+                self.thread = threading.Thread(target=self.loop, name="supervisor", daemon=True)
+                self.thread.start()
+            d.stopping = False
+            d.spawn()
+            self.daemons[d.pidfd] = d
+        self.wake()
+        try:
+            self.wait_ready(d, timeout)
+        except RuntimeError:
+            self.stop(d)
+            raise
+
+    def wait_ready(self, d: Daemon, timeout: float):
+        deadline = time.monotonic() + timeout
+        interval = 0.01
+        p = d.p
+        while not d.ready():
+            if p.poll() is not None:
+                raise RuntimeError(f"{d.name} exited with {p.returncode} before it was ready")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{d.name} is not ready in {timeout}s")
+            time.sleep(interval)
+            interval = min(interval * 2, 0.2)
+
+    def stop(self, d: Daemon):
+        if d.p is None:
+            return
+        with self.lock:
+            d.stopping = True
+            if d in self.waiting:
+                self.waiting.remove(d)
+            running = d.pidfd in self.daemons and self.daemons[d.pidfd] is d
+        if running:
+            d.kill()
+            d.p.wait()
+
+    def loop(self):
+        poller = select.poll()
+        poller.register(self.wake_r, select.POLLIN)
+        registered = set()
         while True:
-            if self.stop:
-                break
-            if self.p.poll() != None:
-                self.exec_anyproxy()
-            time.sleep(1)
+            with self.lock:
+                for fd in self.daemons:
+                    if fd not in registered:
+                        poller.register(fd, select.POLLIN)
+                        registered.add(fd)
+                restart_at = min((d.restart_at for d in self.waiting), default=None)
+            timeout = None if restart_at is None else max(0, (restart_at - time.monotonic()) * 1000)
+
+            for fd, _ in poller.poll(timeout):
+                if fd == self.wake_r:
+                    os.read(self.wake_r, 4096)
+                    continue
+                poller.unregister(fd)
+                registered.discard(fd)
+                with self.lock:
+                    d = self.daemons.pop(fd)
+                os.close(fd)
+                self.exited(d)
+
+            with self.lock:
+                now = time.monotonic()
+                for d in [d for d in self.waiting if d.restart_at <= now]:
+                    self.waiting.remove(d)
+                    d.restarts += 1
+                    d.spawn()
+                    self.daemons[d.pidfd] = d
+
+    def exited(self, d: Daemon):
+        code = d.p.wait()
+        with self.lock:
+            if d.stopping:
+                return
+            if time.monotonic() - d.started_at >= self.stable:
+                d.failures = 0
+            backoff = min(self.max_backoff, self.min_backoff * 2 ** d.failures)
+            d.failures += 1
+            d.restart_at = time.monotonic() + backoff
+            self.waiting.append(d)
+        if self.on_exit:
+            self.on_exit(d, code, backoff)
+
+
+# supervisor keeps the daemons of all hosts running
+supervisor = Supervisor()
+
+
+class AnyProxy(object):
+    def __init__(self, ns: NS):
+        self.ns = ns
 
     def up(self):
         # changing the ulimit needs to reboot the system under linux
-        # so we just do not check it when running on CI
-        if os.environ.get('CI') == None:
+        # so we just do not check it when running on CI (or planning)
+        if os.environ.get('CI') == None and command_runner.records is None:
             ulimit = subprocess.run(['sh', '-c', 'ulimit -n'], stdout=subprocess.PIPE)
             assert(int(ulimit.stdout.strip()) >= 65535)
 
-        self.stop = False
-        self.exec_anyproxy()
-        self.t = threading.Thread(target=self.check)
-        self.t.start()
-    
+        exe = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)),
+            "bin",
+            "any_proxy",
+        )
+        self.daemon = Daemon("any_proxy", exe + " -l=:3140", lambda: listening(self.ns, "tcp", 3140), self.ns)
+        supervisor.start(self.daemon)
+
     def down(self):
-        self.stop = True
-        os.system(f"sudo kill {self.p.pid}")
+        supervisor.stop(self.daemon)
+
+    def diff_key(self):
+        return ("AnyProxy", self.ns.ns_name), ()
 
 
 class FreeDNS(object):
@@ -292,14 +1204,14 @@ class FreeDNS(object):
         if not self.stop_resolved:
             return
 
-        p = subprocess.run("sudo systemctl status systemd-resolved", shell=True, stdout=subprocess.PIPE)
+        p = global_ns.run("systemctl status systemd-resolved", check=False)
         if "active (running) since" in p.stdout.decode():
             self.resolved_stopped_by_self = True
-            assert(os.system("sudo systemctl stop systemd-resolved") == 0)
+            global_ns.run("systemctl stop systemd-resolved")
 
     def restart_systemd_resolve(self):
         if self.resolved_stopped_by_self:
-            os.system("sudo systemctl start systemd-resolved")
+            global_ns.run("systemctl start systemd-resolved", check=False)
 
     def up(self):
         # stop systemd because it uses 53 port
@@ -310,18 +1222,107 @@ class FreeDNS(object):
             "bin",
             "freedns-go",
         )
-        self.p = subprocess.Popen(self.ns.gen_cmd(exe) + f" {self.args}", shell=True)
-        time.sleep(1)
-        assert(self.p.poll() == None) # is running
-    
+        # ready once it listens on the port of `-l [HOST]:PORT`
+        args = self.args.split()
+        port = int(args[args.index("-l") + 1].rsplit(":", 1)[1])
+        self.daemon = Daemon("freedns-go", exe + f" {self.args}", lambda: listening(self.ns, "udp", port), self.ns)
+        supervisor.start(self.daemon)
+
     def down(self):
+        supervisor.stop(self.daemon)
         self.restart_systemd_resolve()
-        os.system(f"sudo kill {self.p.pid}")
+
+    def diff_key(self):
+        return ("FreeDNS", self.ns.ns_name), (self.args, self.stop_resolved)
+
+# conf_name names a compiled config in the trace, e.g. "IPBatch(link, hk)" or "WgConf(wg-bj)"
+def conf_name(c):
+    if type(c) == IPBatch:
+        return f"IPBatch({['ns', 'link', 'addr', 'route'][c.phase]}, {c.ns.ns_name})"
+    if type(c) == WgConf:
+        return f"WgConf({c.wg.name})"
+    if hasattr(c, "name") and type(c.name) == str:
+        return f"{type(c).__name__}({c.name})"
+    if hasattr(c, "ns"):
+        return f"{type(c).__name__}({c.ns.ns_name})"
+    return type(c).__name__
+
+
+class DAGExecutor(object):
+    """
+    DAGExecutor applies the configs on a bounded thread pool, where a config starts as soon as all the configs it
+    depends on are done. If a config fails to come up, no more configs are started, and the ones that are up
+    are brought down in the reverse order they came up, as `ConfSet.up` did when applying them one by one.
+    """
+    def __init__(self, max_workers: typing.Union[int, None] = None):
+        self.max_workers = max_workers if max_workers else min(32, (os.cpu_count() or 1) * 4)
+
+    # call runs `f(c)`, the commands it runs and the time it takes are traced as the config's
+    def call(self, f, c):
+        name = conf_name(c)
+        token = runner.owner.set(name)
+        try:
+            with command_runner.span("conf", name, threading.current_thread().name):
+                return f(c)
+        finally:
+            runner.owner.reset(token)
+
+    # schedule runs `f` on `confs` ordered by `deps` (the indexes each one depends on),
+    # returns the indexes of the confs done in order and the first error
+    def schedule(self, confs: list, deps: list, f):
+        waiting = [len(d) for d in deps]
+        dependents = [[] for _ in confs]
+        for i, d in enumerate(deps):
+            for j in d:
+                dependents[j].append(i)
+
+        done = []
+        error = None
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            running = {pool.submit(self.call, f, confs[i]): i for i in range(len(confs)) if waiting[i] == 0}
+            while len(running) > 0:
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                # in the order of the confs, so a single worker applies them in a deterministic order
+                for fut in sorted(finished, key=lambda fut: running[fut]):
+                    i = running.pop(fut)
+                    if fut.exception() is not None:
+                        error = error if error else fut.exception()
+                        continue
+                    done.append(i)
+                    if error:
+                        continue
+                    for j in dependents[i]:
+                        waiting[j] -= 1
+                        if waiting[j] == 0:
+                            running[pool.submit(self.call, f, confs[j])] = j
+        return done, error
+
+    def up(self, confs: list, deps: list):
+        done, error = self.schedule(confs, deps, lambda c: c.up())
+        if error:
+            # roll back
+            if type(error) == IPBatchError:
+                self.call(lambda c: c.down(), error.applied)
+            for i in done[::-1]:
+                self.call(lambda c: c.down(), confs[i])
+            raise error
+
+    # down brings down a config after all the configs depending on it
+    def down(self, confs: list, deps: list):
+        dependents = [[] for _ in confs]
+        for i, d in enumerate(deps):
+            for j in d:
+                dependents[j].append(i)
+        _, error = self.schedule(confs, dependents, lambda c: c.down())
+        if error:
+            raise error
+
 
 # ConfSet is a set of netowrk configs
 class ConfSet(object):
-    def __init__(self):
+    def __init__(self, ip_backend=None):
         self.conf = []
+        self.ip_backend = ip_backend
     
     def add(self, c):
         if type(c) == list or type(c) == tuple:
@@ -331,22 +1332,169 @@ class ConfSet(object):
 
     def add_begin(self, c):
         self.conf = [c] + self.conf
-    
-    def up(self):
-        succ = []
+
+    # compile merges the configs that can be applied together.
+    # The `ip` lines of all configs are grouped into one `IPBatch` per (phase, namespace), which are applied
+    # before the other configs. All `IPTableRule`s of a namespace are replaced by one `IPTableBatch`, placed
+    # at the position of the last rule so that everything the rules depend on (e.g. ipsets) is already up.
+    def compile(self):
+        ip_batches = {}
         for c in self.conf:
-            try:
-                c.up()
-            except Exception as e:
-                # roll back
-                for c in succ[::-1]:
-                    c.down()
-                raise e
-            succ.append(c)
+            if not hasattr(c, "ip_up_lines"):
+                continue
+            for phase, ns, _ in c.ip_up_lines() + c.ip_down_lines():
+                key = (phase, ns.ns_name)
+                if key not in ip_batches:
+                    ip_batches[key] = IPBatch(phase, ns, self.ip_backend)
+                b = ip_batches[key]
+                if len(b.confs) == 0 or b.confs[-1] is not c:
+                    b.add(c)
+
+        batches = {}
+        last = {}
+        for i, c in enumerate(self.conf):
+            if type(c) == IPTableRule:
+                name = c.ns.ns_name
+                if name not in batches:
+                    batches[name] = IPTableBatch(c.ns)
+                batches[name].add(c)
+                last[name] = i
+
+        confs = []
+        for phase in IP_PHASES:
+            confs += [b for (p, _), b in ip_batches.items() if p == phase]
+        for i, c in enumerate(self.conf):
+            if type(c) == IPTableRule:
+                name = c.ns.ns_name
+                if last[name] == i:
+                    confs.append(batches[name])
+            elif type(c) == Wg or type(c) == WgIface:
+                confs.append(WgConf(c))
+            elif not hasattr(c, "ip_up_lines"):
+                confs.append(c)
+        return confs
+
+    # plan returns the compiled configs and the indexes of the configs each of them depends on.
+    # An `ip` batch depends on the batches of the earlier phases, e.g. the addresses need the links in all namespaces
+    # (the veths) to exist. The other configs depend on all the batches, and an `IPTableBatch` also depends on the
+    # configs before it in its namespace (e.g. the ipsets), so the tunnels, ipsets and daemons start in parallel.
+    def plan(self):
+        confs = self.compile()
+        deps = []
+        batches = []
+        in_ns = {}
+        for i, c in enumerate(confs):
+            if type(c) == IPBatch:
+                deps.append([j for j in batches if confs[j].phase < c.phase])
+                batches.append(i)
+                continue
+            ns = getattr(c, "ns", None)
+            ns = ns.ns_name if ns else None
+            deps.append(batches + (in_ns.get(ns, []) if type(c) == IPTableBatch else []))
+            in_ns.setdefault(ns, []).append(i)
+        return confs, deps
+
+    def up(self, executor: typing.Union[DAGExecutor, None] = None):
+        (executor if executor else DAGExecutor()).up(*self.plan())
+
+    def down(self, executor: typing.Union[DAGExecutor, None] = None):
+        (executor if executor else DAGExecutor()).down(*self.plan())
+
+
+# merge_plans merges the plans of independent `ConfSet`s into one
+def merge_plans(plans: list):
+    confs = []
+    deps = []
+    for c, d in plans:
+        deps += [[j + len(confs) for j in js] for js in d]
+        confs += c
+    return confs, deps
+
+
+# Update is a config whose `up` changes a live config in place, see `diff_confs`
+class Update(object):
+    def __init__(self, f, ns: NS):
+        self.f = f
+        self.ns = ns
+
+    def up(self):
+        self.f()
 
     def down(self):
-        for c in self.conf[::-1]:
-            c.down()
+        pass
+
+
+# conf_key returns (ident, spec) of a config. The configs with the same ident are the same kernel objects (or daemons),
+# which are unchanged if the specs are the same as well.
+def conf_key(c):
+    if hasattr(c, "diff_key"):
+        return c.diff_key()
+    # the down lines name the kernel objects, the up lines describe them
+    ident = (type(c).__name__,) + tuple((ns.ns_name, l) for _, ns, l in c.ip_down_lines())
+    spec = tuple((ns.ns_name, l) for _, ns, l in c.ip_up_lines())
+    if hasattr(c, "gen_conf"):
+        spec += (c.gen_conf(),)
+    return ident, spec
+
+
+def diff_confs(old: list, new: list):
+    """
+    Compares the live configs `old` of a host with the `new` ones, returns the steps turning the old into the new,
+    [("down" | "up", configs)], and the configs live afterwards, in which the unchanged ones are the old objects
+    (e.g. the running daemons).
+    A changed config is updated in place if it has `diff(old)`, which returns the configs to bring down and up,
+    otherwise it is brought down and up again. The steps are:
+      1. down the removed configs, e.g. the routes through a removed link
+      2. up the added configs and update the changed ones, e.g. the new ipsets
+      3. swap the firewall rules, which may reference the new ipsets or stop referencing the removed ones
+      4. down the removed ipsets
+    """
+    olds = {}
+    for c in old:
+        if type(c) != IPTableRule:
+            ident, spec = conf_key(c)
+            olds[ident] = (c, spec)
+
+    downs, ups, firewall, ipsets = [], [], [], []
+    confs = []
+    for c in new:
+        if type(c) == IPTableRule:
+            confs.append(c)
+            continue
+        ident, spec = conf_key(c)
+        o, old_spec = olds.pop(ident, (None, None))
+        if o is not None and spec == old_spec:
+            confs.append(o)
+            continue
+        confs.append(c)
+        d = c.diff(o) if o is not None and hasattr(c, "diff") else None
+        if o is None:
+            ups.append(c)
+        elif d is None:
+            downs.append(o)
+            ups.append(c)
+        else:
+            downs += d[0]
+            (firewall if type(c) == NftRuleset else ups).extend(d[1])
+    for o, _ in olds.values():
+        (ipsets if type(o) == IPSet else downs).append(o)
+
+    # the iptables rules of a namespace are swapped together, since their order matters
+    old_rules, new_rules = {}, {}
+    for cs, rules in ((old, old_rules), (new, new_rules)):
+        for c in cs:
+            if type(c) == IPTableRule:
+                if c.ns.ns_name not in rules:
+                    rules[c.ns.ns_name] = IPTableBatch(c.ns)
+                rules[c.ns.ns_name].add(c)
+    for name in list(old_rules) + [n for n in new_rules if n not in old_rules]:
+        o = old_rules.get(name, IPTableBatch(NS(name)))
+        b = new_rules.get(name, IPTableBatch(NS(name)))
+        if [(r.table, r.chain, r.rule) for r in o.rules] != [(r.table, r.chain, r.rule) for r in b.rules]:
+            firewall.append(Update(lambda b=b, o=o: b.replace(o), b.ns))
+
+    steps = [("down", downs), ("up", ups), ("up", firewall), ("down", ipsets)]
+    return [(op, c) for op, c in steps if len(c) > 0], confs
 
 
 class Host(object):
@@ -356,22 +1504,22 @@ class Host(object):
         self.key = key
         self.ns = ns
         self.confs = ConfSet()
-        self.ipsets_in_confs = {}
+        self.ipsets = {} # name -> IPSet in self.ns
+        self.policies = [] # List[(kind, src_ip, ipsetbundle, next_hop)], see `policy_route`
         self.lan_cidrs = []
 
         self.route_table_counter = 100
         self.nat_gateway = False
+        self.wg_iface = None
 
     # claim the cidr that is reachable from this host
     def claim_lan_cidr(self, cidr):
         self.lan_cidrs.append(cidr)
     
     def add_ipset(self, ipset):
-        if ipset.name not in self.ipsets_in_confs:
+        if ipset.name not in self.ipsets:
             # reconstruct it to make sure the ipset is in self.ns
-            ipset = IPSet(ipset.name, ipset.ips, self.ns)
-            self.confs.add_begin(ipset)
-            self.ipsets_in_confs[ipset.name] = True
+            self.ipsets[ipset.name] = IPSet(ipset.name, ipset.ips_source, self.ns)
 
     def policy_route(self, local_output: bool, nat_gateway: bool, src_ip: str, ipsetbundle: IPSetBundle, next_hop: str):
         assert(not(local_output and nat_gateway))
@@ -382,42 +1530,173 @@ class Host(object):
             ap = AnyProxy(self.ns)
             self.confs.add(ap)
 
-        route_table = self.route_table_counter
-        self.route_table_counter += 1
+        # the marks, routing tables and firewall rules are added by `render_firewall`
+        if local_output:
+            self.policies.append(("output", src_ip, ipsetbundle, next_hop))
+        elif not nat_gateway:
+            self.policies.append(("forward", src_ip, ipsetbundle, next_hop))
+        else:
+            self.policies.append(("nat", src_ip, ipsetbundle, next_hop))
+
+    def assign_route_tables(self):
+        """
+        Assigns the marks to the policies and adds the routing table of each mark, which uses the same number.
+        There is one mark, table and `ip rule` per distinct next hop, shared by the output and the forwarded traffic
+        of all the sources and bundles, so the rules the kernel walks scale with the next hops rather than the clients.
+        Returns [(kind, src_ip, ipsetbundle, mark)].
+        """
+        tables = {} # next_hop -> mark
+        snat = {} # mark -> src_ip the local output is SNAT-ed to
+        marked = []
+        for kind, src_ip, ipsetbundle, next_hop in self.policies:
+            if kind == "nat":
+                marked.append((kind, src_ip, ipsetbundle, None))
+                continue
+
+            if next_hop not in tables:
+                route_table = self.route_table_counter
+                self.route_table_counter += 1
+                tables[next_hop] = route_table
+                self.confs.add(Route("default", next_hop, route_table, self.ns))
+                self.confs.add(RouteRule(route_table, route_table, self.ns))
+            mark = tables[next_hop]
+            if kind == "output":
+                # the source address is the one on the link to the next hop, so it is the same for a mark
+                assert(snat.setdefault(mark, src_ip) == src_ip)
+            marked.append((kind, src_ip, ipsetbundle, mark))
+        return marked
+
+    @staticmethod
+    def group_sources(policies: list):
+        """
+        Groups the sources of `policies` ([(key, src_ip)]) by key, returning [(key, [src_ip])] in the order of
+        the first occurrence of each key. The rules of a source are matched in order and the first one wins
+        (they all require mark 0), so a source whose keys would be reordered by the grouping is left in groups
+        of its own, in its own order.
+        """
+        order = {}
+        by_src = {}
+        for key, src_ip in policies:
+            order.setdefault(key, len(order))
+            keys = by_src.setdefault(src_ip, [])
+            if key not in keys:
+                keys.append(key)
+
+        groups = {key: [] for key in order}
+        alone = []
+        for src_ip, keys in by_src.items():
+            idx = [order[k] for k in keys]
+            if idx == sorted(idx):
+                for k in keys:
+                    groups[k].append(src_ip)
+            else:
+                alone += [(k, [src_ip]) for k in keys]
+        return [(k, srcs) for k, srcs in groups.items() if len(srcs) > 0] + alone
 
-        bundle_cond = ipsetbundle.gen_iptables_condition()
-        match_src =f"-s {src_ip}"
+    def gen_iptables_rules(self, policies: list):
+        """
+        Returns the ipsets and the iptables rules implementing `policies`.
+        The sources sharing a bundle and a mark are matched by one `hash:net` set of sources, so a packet goes through
+        one rule per group rather than one rule per client.
+        """
+        ipsets = []
+        rules = []
         mark_0 = "-m mark --mark 0"
         not_established= "-m state ! --state ESTABLISHED,RELATED"
-        target = f"-j MARK --set-mark {route_table}"
 
-        if local_output:
-            # important:
-            # uses connmark to track the connection so for the traffic originating from the outside won't go through the table
-            # test cases may not test this well! Be careful when making change.
-            self.confs.add(IPTableRule("mangle", "OUTPUT", f"{bundle_cond} {mark_0} {not_established} -j CONNMARK --set-mark {route_table}", self.ns))
-            self.confs.add(IPTableRule("mangle", "OUTPUT", f"-m connmark --mark {route_table} {target}", self.ns)) # equals to `-j restore-mark`
-            self.confs.add(IPTableRule("nat", "POSTROUTING", f"-m mark --mark {route_table} -j SNAT --to-source {src_ip}", self.ns))
-        elif not nat_gateway:
-            self.confs.add(IPTableRule("mangle", "PREROUTING", f"{bundle_cond} {mark_0} {match_src} {target}", self.ns))
-        else:
-            self.confs.add(IPTableRule("nat", "POSTROUTING", f"{bundle_cond} {mark_0} {match_src} ! -p tcp -j MASQUERADE", self.ns))
-            self.confs.add(IPTableRule("nat", "PREROUTING",  f"{bundle_cond} {mark_0} {match_src} -p tcp -j REDIRECT --to-ports 3140", self.ns))
+        src_sets = {} # (kind, sources) -> IPSet, the groups of the same sources share a set
+        def match_src(kind, srcs):
+            if len(srcs) == 1:
+                return f"-s {srcs[0]}"
+            key = (kind, frozenset(srcs))
+            if key not in src_sets:
+                src_sets[key] = IPSet(f"src-{kind}-{len(ipsets)}", srcs, self.ns)
+                ipsets.append(src_sets[key])
+            return f"-m set --match-set {src_sets[key].name} src"
+
+        snat = {} # mark -> src_ip
+        for kind, src_ip, ipsetbundle, route_table in policies:
+            if kind == "output":
+                bundle_cond = ipsetbundle.gen_iptables_condition()
+                # important:
+                # uses connmark to track the connection so for the traffic originating from the outside won't go through the table
+                # test cases may not test this well! Be careful when making change.
+                # the first policy matching a new connection sets its connmark, the marks are restored below
+                rules.append(IPTableRule("mangle", "OUTPUT", f"{bundle_cond} {mark_0} {not_established} -m connmark --mark 0 -j CONNMARK --set-mark {route_table}", self.ns))
+                snat[route_table] = src_ip
+        for route_table in snat:
+            # equals to `-j restore-mark`, once per mark
+            rules.append(IPTableRule("mangle", "OUTPUT", f"-m connmark --mark {route_table} -j MARK --set-mark {route_table}", self.ns))
+        for route_table, src_ip in snat.items():
+            # the mark is shared with the forwarded traffic, which never sets the connmark
+            rules.append(IPTableRule("nat", "POSTROUTING", f"-m connmark --mark {route_table} -j SNAT --to-source {src_ip}", self.ns))
+
+        forward = [((b, m), s) for k, s, b, m in policies if k == "forward"]
+        for (ipsetbundle, route_table), srcs in self.group_sources(forward):
+            bundle_cond = ipsetbundle.gen_iptables_condition()
+            target = f"-j MARK --set-mark {route_table}"
+            rules.append(IPTableRule("mangle", "PREROUTING", f"{bundle_cond} {mark_0} {match_src('fwd', srcs)} {target}", self.ns))
+
+        nat = [(b, s) for k, s, b, _ in policies if k == "nat"]
+        for ipsetbundle, srcs in self.group_sources(nat):
+            bundle_cond = ipsetbundle.gen_iptables_condition()
+            src = match_src("nat", srcs)
+            rules.append(IPTableRule("nat", "POSTROUTING", f"{bundle_cond} {mark_0} {src} ! -p tcp -j MASQUERADE", self.ns))
+            rules.append(IPTableRule("nat", "PREROUTING",  f"{bundle_cond} {mark_0} {src} -p tcp -j REDIRECT --to-ports 3140", self.ns))
+        return ipsets, rules
+
+    # render_firewall adds the ipsets and the rules implementing `self.policies`, by "iptables" or "nft"
+    def render_firewall(self, firewall: str):
+        if len(self.policies) == 0:
+            return
+        policies = self.assign_route_tables()
+        if firewall == "nft":
+            self.confs.add(NftRuleset(list(self.ipsets.values()), policies, self.ns))
+            return
 
-        if not nat_gateway:
-            self.confs.add(Route("default", next_hop, route_table, self.ns))
-            self.confs.add(RouteRule(route_table, route_table, self.ns))
+        assert(firewall == "iptables")
+        src_ipsets, rules = self.gen_iptables_rules(policies)
+        for ipset in list(self.ipsets.values()) + src_ipsets:
+            self.confs.add_begin(ipset)
+        self.confs.add(rules)
 
 class Network(object):
-    def __init__(self, mock_net: bool):
+    def __init__(self, mock_net: bool, netlink: bool = False, firewall: str = "iptables", summarize_routes: bool = True,
+                 single_interface: bool = False, session: bool = False, mtu: int = 1360):
+        """
+        `netlink` applies the `ip` commands through the in-process `NetlinkBackend` instead of `ip -batch`,
+        which requires running as root.
+        `firewall` is "iptables" (with ipsets) or "nft", which implements the policy routing by `NftRuleset`.
+        `summarize_routes` merges the static routes through the same next hop into covering prefixes,
+        see `summarize_routes`.
+        `single_interface` puts all the peers of a host on one `WgIface` listening on one port, the port of the first
+        link it accepts. A peer is chosen by the destination address, so the routes have to be symmetric (e.g. a tree
+        topology) and a host can have at most one next hop for its policy routing.
+        `session` starts one privileged helper (see `helper.py`) on the first command and sends all the commands to
+        it, instead of spawning `sudo` for each one. The `ip` lines are applied by the helper through rtnetlink.
+        `mtu` is the mtu of the wireguard interfaces.
+        """
+        assert(firewall in ("iptables", "nft"))
+        # the runner switches to the session when this network runs commands, see `use_session`
+        self.session = helper.Session(root_ns=global_ns.ns_name) if session else None
+        if session:
+            self.ip_backend = HelperBackend()
+        else:
+            self.ip_backend = NetlinkBackend() if netlink else IPCmdBackend()
+        self.firewall = firewall
+        self.summarize_routes = summarize_routes
+        self.single_interface = single_interface
+        self.mtu = mtu
         self.hosts = {}
-        self.edges = {}
+        self.edges = {} # name -> List[[neighbor, ip, neighbor_ip, weight, name]]
+        self.weighted = False
+        self.links = [] # List[(left, right, cidr, port)], the `Wg`s are built by `compile`
         self.output_to_nat_list = [] # List[(ipset_bundle, src, nat_gatway)]
         self.computed_routing_info = False
 
         self.mock_net = mock_net
         if mock_net:
-            self.mock_conf = ConfSet()
+            self.mock_conf = ConfSet(self.ip_backend)
             self.hub_ns = NS("hub")
             self.mock_conf.add([
                 self.hub_ns,
@@ -462,68 +1741,95 @@ class Network(object):
         else:
             host = Host(name, wan_ip, key, global_ns)
 
+        host.confs.ip_backend = self.ip_backend
         self.hosts[host.name] = host
         self.edges[host.name] = []
 
-    def connect(self, left: str, right: str, cidr: str, port: int):
+    def connect(self, left: str, right: str, cidr: str, port: int, weight: typing.Union[float, None] = None):
+        """
+        `weight` is the cost of the link, e.g. its latency. The routes take the fewest hops if no link has a weight,
+        otherwise the lowest total weight, where a link without a weight costs 1.
+        """
         left = self.hosts[left]
         right = self.hosts[right]
 
-        lwg, rwg = gen_wg(
-            name=f"{left.name}.{right.name}",
-            left_key = left.key,
-            right_key = right.key,
-            right_wan_ip = right.wan_ip,
-            link_cidr = cidr,
-            port = port,
-            mtu = 1360,
-            left_ns = left.ns,
-            right_ns = right.ns
-        )
-        left.confs.add(lwg)
-        right.confs.add(rwg)
-        lip = lwg.addr.split("/")[0]
-        rip = rwg.addr.split("/")[0]
+        self.links.append((left.name, right.name, cidr, port))
+        lip, rip = link_addrs(cidr)
+        lip = lip.split("/")[0]
+        rip = rip.split("/")[0]
         left.claim_lan_cidr(lip)
         right.claim_lan_cidr(rip)
-        self.edges[left.name].append([right.name, lip, rip])
-        self.edges[right.name].append([left.name, rip, lip])
+        if weight is not None:
+            assert(weight > 0)
+            self.weighted = True
+        else:
+            weight = 1
+        self.edges[left.name].append([right.name, lip, rip, weight, left.name])
+        self.edges[right.name].append([left.name, rip, lip, weight, right.name])
 
     def output_to_nat_gateway(self, ipsetbundle: IPSetBundle, src: str, gateway: str):
         assert(src in self.hosts)
         assert(gateway in self.hosts)
         self.output_to_nat_list.append((ipsetbundle, src, gateway))
 
-    def _pass_2_output_to_nat_gateway(self):
-        # uses bfs to find a shortest path 
-        def shortest_path(start: str, end: str):
-            vis = {name: False for name in self.hosts}
-            edges = {name: () for name in self.hosts}
-
-            vis[start] = True
-            q = [start]
-
+    def shortest_path_tree(self, root: str):
+        """
+        Returns the shortest path tree rooted at `root` as {v: edge}, where `edge` is the edge `[v, u_ip, v_ip, weight, u]`
+        of the parent `u` of `v`. It is a bfs tree, or a dijkstra tree if the links have weights.
+        """
+        tree = {}
+        if not self.weighted:
+            vis = {root}
+            q = collections.deque([root])
             while len(q) > 0:
-                u = q[0]
-                q = q[1:]
-                for v, tunnel_ip, next_hop in self.edges[u]:
-                    if vis[v]:
+                u = q.popleft()
+                for e in self.edges[u]:
+                    v = e[0]
+                    if v in vis:
                         continue
-                    vis[v] = True
+                    vis.add(v)
                     q.append(v)
-                    edges[v] = (u, v, tunnel_ip, next_hop) # u -> v via next_hop
+                    tree[v] = e
+            return tree
+
+        dist = {root: 0}
+        done = set()
+        # the counter breaks the ties in the order the hosts are reached, as the bfs does
+        heap = [(0, 0, root, None)]
+        counter = 1
+        while len(heap) > 0:
+            d, _, u, e = heapq.heappop(heap)
+            if u in done:
+                continue
+            done.add(u)
+            if e is not None:
+                tree[u] = e
+            for e in self.edges[u]:
+                v, w = e[0], e[3]
+                if v not in done and d + w < dist.get(v, float("inf")):
+                    dist[v] = d + w
+                    heapq.heappush(heap, (d + w, counter, v, e))
+                    counter += 1
+        return tree
+
+    def _pass_2_output_to_nat_gateway(self):
+        # the shortest path trees rooted at the gateways, shared by all the sources using a gateway.
+        # The paths are the same as the static routes towards the gateway.
+        trees = {}
+
+        def shortest_path(start: str, end: str):
+            if end not in trees:
+                trees[end] = self.shortest_path_tree(end)
+            tree = trees[end]
+            assert(start in tree)
 
-                    if v == end:
-                        break
-            
-            assert(vis[v])
-            # recover the path from `start` to `end`
+            # follow the parents from `start` to the root `end`
             paths = []
-            u = end
-            while u != start:
-                paths.append(edges[u])
-                u = edges[u][0]
-            paths = paths[::-1] # reverse edges
+            u = start
+            while u != end:
+                _, next_hop, tunnel_ip, _, v = tree[u]
+                paths.append((u, v, tunnel_ip, next_hop)) # u -> v via next_hop
+                u = v
             return paths
 
         def f(ipsetbundle, src, gateway):
@@ -548,51 +1854,250 @@ class Network(object):
         for ipsetbundle, src, gateway in self.output_to_nat_list:
             f(ipsetbundle, src, gateway)
 
-    def _pass_1_compute_static_route(self):
-        def compute_routeings(start):
-            cidrs = self.hosts[start].lan_cidrs
-            vis = {name: False for name in self.hosts}
-            vis[start] = True
-            q = [start]
+    # endpoint_port is the port `host` connects to for its link to `peer`
+    def endpoint_port(self, host: str, peer: str):
+        if self.single_interface:
+            return [p for _, r, _, p in self.links if r == peer][0]
+        return [p for l, r, _, p in self.links if {l, r} == {host, peer}][0]
+
+    def _pass_0_build_links(self):
+        if self.single_interface:
+            # a host listens on the port of the first link it accepts
+            ports = {}
+            for _, right, _, port in self.links:
+                ports.setdefault(right, port)
+
+            for left, right, cidr, _ in self.links:
+                left = self.hosts[left]
+                right = self.hosts[right]
+                for h in (left, right):
+                    if h.wg_iface is None:
+                        h.wg_iface = WgIface(h.key, ports.get(h.name), self.mtu, h.ns)
+
+                lip, rip = link_addrs(cidr)
+                lip = lip.split("/")[0]
+                rip = rip.split("/")[0]
+                left.wg_iface.add_peer(f"{lip}/30", rip, right.key, f"{right.wan_ip}:{ports[right.name]}")
+                right.wg_iface.add_peer(f"{rip}/30", lip, left.key, None)
+                left.wg_iface.peers[rip][2].append(cidr)
+                right.wg_iface.peers[lip][2].append(cidr)
+            for h in self.hosts.values():
+                if h.wg_iface is not None:
+                    h.confs.add(h.wg_iface)
+            return
 
-            while len(q) > 0:
-                u = q[0]
-                q = q[1:]
-                for v, next_hop, _ in self.edges[u]:
-                    if vis[v]:
-                        continue
-                    vis[v] = True
-                    q.append(v)
+        for left, right, cidr, port in self.links:
+            left = self.hosts[left]
+            right = self.hosts[right]
+            lwg, rwg = gen_wg(
+                name=f"{left.name}.{right.name}",
+                left_key = left.key,
+                right_key = right.key,
+                right_wan_ip = right.wan_ip,
+                link_cidr = cidr,
+                port = port,
+                mtu = self.mtu,
+                left_ns = left.ns,
+                right_ns = right.ns
+            )
+            left.confs.add(lwg)
+            right.confs.add(rwg)
 
-                    # connect
-                    for cidr in cidrs:
-                        if cidr != next_hop:
-                            #print(f"{v} -> {cidr} via {next_hop}")
-                            self.hosts[v].confs.add(Route(cidr, next_hop, "main", self.hosts[v].ns))
+    def _pass_1_compute_static_route(self):
+        hosts = list(self.hosts.values())
+        # next_hops[v][i] is the next hop from host `v` towards the i-th host,
+        # None for `v` itself and False if it is unreachable
+        next_hops = {}
+        for i, h in enumerate(hosts):
+            next_hops[h.name] = [False] * len(hosts)
+            next_hops[h.name][i] = None
+
+        # the shortest path tree rooted at every host gives the next hop from all other hosts towards it
+        for i, h in enumerate(hosts):
+            if len(h.lan_cidrs) == 0:
+                continue
+            for v, e in self.shortest_path_tree(h.name).items():
+                next_hops[v][i] = e[1]
+
+        if self.single_interface:
+            # kept for `_pass_4_set_allowed_ips`
+            self.next_hops = next_hops
+
+        if self.summarize_routes:
+            prefixes, others = claimed_prefixes(hosts, self.links)
+            # the addresses of a host always have the same next hop, so they are merged once for all hosts
+            owners = list(range(len(hosts))) + [None]
+            prefixes = [(n, p, -1 if o is None else o, f) for n, p, o, f in summarize_routes(prefixes, owners)]
+            # the link `/30`s of every host, which are routed to the peer on the link -> (peer address, peer index)
+            index = {h.name: i for i, h in enumerate(hosts)}
+            connected = {h.name: {} for h in hosts}
+            for left, right, cidr, _ in self.links:
+                net = int.from_bytes(socket.inet_pton(socket.AF_INET, cidr.split("/")[0]), "big")
+                lip, rip = link_addrs(cidr)
+                connected[left][net] = (rip.split("/")[0], index[right])
+                connected[right][net] = (lip.split("/")[0], index[left])
+            # most hosts are clients that reach everything through one next hop, they share one summary
+            summary_of_all = None
+
+        for h in hosts:
+            r = Routes("main", h.ns)
+            if self.summarize_routes:
+                # the last label is for the addresses owned by no host
+                labels = next_hops[h.name] + [None]
+                vias = set(labels) - {None}
+                if len(vias) == 1 and False not in vias and len(h.lan_cidrs) == len(connected[h.name]):
+                    if summary_of_all is None:
+                        summary_of_all = summarize_routes(prefixes, [True] * len(labels))
+                    via = vias.pop()
+                    summary = [(net, plen, via, fixed) for net, plen, _, fixed in summary_of_all]
+                else:
+                    summary = summarize_routes(prefixes, labels)
 
-        # compute routing about from other hosts to self.hosts[name].cidrs
-        for name in self.hosts:
-            compute_routeings(name)
+                by_via = {}
+                for net, plen, via, _ in summary:
+                    # the prefixes inside a link of the host are reached through the link
+                    if not via or (plen >= 30 and net & ~3 in connected[h.name]):
+                        continue
+                    addr = socket.inet_ntop(socket.AF_INET, net.to_bytes(4, "big"))
+                    by_via.setdefault(via, []).append(addr if plen == 32 else f"{addr}/{plen}")
+                # a peer reached through a lighter path than their link needs a route more specific than the link
+                for peer, owner in connected[h.name].values():
+                    if labels[owner] and labels[owner] != peer:
+                        by_via.setdefault(labels[owner], []).append(peer)
+                for cidr, owner in others:
+                    if labels[owner]:
+                        by_via.setdefault(labels[owner], []).append(cidr)
+                for via, cidrs in by_via.items():
+                    r.add(cidrs, via)
+            else:
+                for i, via in enumerate(next_hops[h.name]):
+                    if via:
+                        r.add(hosts[i].lan_cidrs, via)
+            if len(r) > 0:
+                h.confs.add(r)
+
+    def _pass_3_render_firewall(self):
+        for h in self.hosts.values():
+            h.render_firewall(self.firewall)
+
+    # sets the allowed ips of the peers on the `WgIface`s: the link, the routes through the peer,
+    # and the default route for the next hop of the policy routing
+    def _pass_4_set_allowed_ips(self):
+        index = {name: i for i, name in enumerate(self.hosts)}
+        for h in self.hosts.values():
+            iface = h.wg_iface
+            if iface is None:
+                continue
+            if len(iface.peers) == 1:
+                for peer in iface.peers.values():
+                    peer[2] = ["0.0.0.0/0"]
+                continue
+
+            for r in h.confs.conf:
+                if type(r) == Routes:
+                    for cidr, via in r.routes():
+                        iface.peers[via][2].append(cidr)
+            egress = {next_hop for kind, _, _, next_hop in h.policies if kind != "nat"}
+            assert(len(egress) <= 1), f"{h.name} has more than one next hop for the policy routing"
+            for next_hop in egress:
+                iface.peers[next_hop][2].append("0.0.0.0/0")
+
+            # the peer a packet comes from has to be allowed its source, namely the peer routing back to the source
+            arrival = {}
+            for v, e in self.shortest_path_tree(h.name).items():
+                arrival[v] = e[2] if e[4] == h.name else arrival[e[4]]
+                assert(arrival[v] == self.next_hops[h.name][index[v]]), f"the routes between {h.name} and {v} are asymmetric"
 
     def add_freedns(self, host, listen="0.0.0.0:53"):
         h = self.hosts[host]
         h.confs.add(FreeDNS(f"-l {listen} -c 1.1.1.1:53", stop_resolved=(not self.mock_net), ns=h.ns))
 
-    def up(self, host: str):
+    # compile builds the configs of all hosts. It is deferred until a host is brought up,
+    # so commands which only need the topology never touch the keys or the ipset contents.
+    def compile(self):
         if not self.computed_routing_info:
             self.computed_routing_info = True
-            self._pass_1_compute_static_route()
-            self._pass_2_output_to_nat_gateway()
+            passes = [self._pass_0_build_links, self._pass_1_compute_static_route, self._pass_2_output_to_nat_gateway,
+                      self._pass_3_render_firewall]
+            if self.single_interface:
+                passes.append(self._pass_4_set_allowed_ips)
+            for p in passes:
+                with command_runner.span("pass", p.__name__, "compile"):
+                    p()
+
+    # use_session sends the commands to the helper of this network, which is started by the first command
+    def use_session(self):
+        if self.session:
+            command_runner.use_session(self.session)
 
+    def up(self, host: str):
+        self.compile()
+        self.use_session()
         self.hosts[host].confs.up()
 
+    # refresh_ipsets reloads the ipsets of a running host without touching its other configs
+    def refresh_ipsets(self, host: str):
+        self.compile()
+        self.use_session()
+        for c in self.hosts[host].confs.conf:
+            if type(c) == IPSet or type(c) == NftRuleset:
+                c.refresh()
+
     def down(self, host: str):
+        self.use_session()
         self.hosts[host].confs.down()
 
+    def plan(self, host: str):
+        """
+        Returns the commands bringing up `host` without running them, see `runner.Runner.recording`.
+        The configs are applied one by one in the order of their dependencies, so the plan is deterministic.
+        """
+        self.compile()
+        confs, deps = self.hosts[host].confs.plan()
+        for c in confs:
+            if type(c) == IPBatch:
+                # the in-process backends would touch the kernel
+                c.ip_backend = IPCmdBackend()
+        with command_runner.recording() as records:
+            DAGExecutor(max_workers=1).up(confs, deps)
+        return records
+
+    # reload brings the running `host` of the `old` network to the configs of this network, only the configs which
+    # differ are touched (see `diff_confs`), e.g. adding a client changes its link, a few routes and the firewall.
+    # Returns the steps applied.
+    def reload(self, host: str, old: "Network"):
+        self.compile()
+        # the running helper is kept
+        if self.session and old.session:
+            self.session = old.session
+        self.use_session()
+        h = self.hosts[host]
+        steps, confs = diff_confs(old.hosts[host].confs.conf, h.confs.conf)
+        for op, c in steps:
+            step = ConfSet(self.ip_backend)
+            step.add(c)
+            step.up() if op == "up" else step.down()
+        h.confs.conf = confs
+        return steps
+
+    # up_hosts brings up the hosts in parallel, which are independent in the mock net
+    def up_hosts(self, hosts: list):
+        assert(self.mock_net)
+        self.compile()
+        self.use_session()
+        DAGExecutor().up(*merge_plans([self.hosts[h].confs.plan() for h in hosts]))
+
+    def down_hosts(self, hosts: list):
+        assert(self.mock_net)
+        self.use_session()
+        DAGExecutor().down(*merge_plans([self.hosts[h].confs.plan() for h in hosts]))
+
     def up_mock_net(self):
         assert(self.mock_net)
+        self.use_session()
         self.mock_conf.up()
     
     def down_mock_net(self):
         assert(self.mock_net)
+        self.use_session()
         self.mock_conf.down()
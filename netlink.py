@@ -0,0 +1,372 @@
+import contextlib
+import ctypes
+import os
+import socket
+import struct
+
+""" A minimal rtnetlink client, which applies the `ip` lines generated by `mesh` without spawning `ip`.
+
+Only the subset of the `ip` syntax used by `mesh` is supported:
+
+    link add [dev] NAME type wireguard
+    link add [dev] NAME type veth peer name PEER [netns NS]
+    link set [dev] NAME [up] [mtu MTU]
+    link del [dev] NAME
+    addr add CIDR dev NAME
+    route add|del DST via GATEWAY table TABLE
+    rule add|del fwmark MARK table TABLE
+
+It must run as root, since it enters the namespaces and talks to the kernel directly.
+"""
+
+NETLINK_ROUTE = 0
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+NLM_F_DUMP = 0x300
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_NEWRULE = 32
+RTM_DELRULE = 33
+
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_LINKINFO = 18
+IFLA_NET_NS_FD = 28
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+VETH_INFO_PEER = 1
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+RTA_DST = 1
+RTA_GATEWAY = 5
+RTA_TABLE = 15
+
+FRA_FWMARK = 10
+FRA_TABLE = 15
+FR_ACT_TO_TBL = 1
+
+IFF_UP = 0x1
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_NOWHERE = 255
+RTN_UNICAST = 1
+RT_TABLE_UNSPEC = 0
+
+CLONE_NEWNET = 0x40000000
+
+# the kernel is given at most this many messages before we wait for their ACKs
+MAX_INFLIGHT = 512
+
+NOT_EXECUTED = "not executed"
+
+TABLES = {"default": 253, "main": 254, "local": 255}
+
+
+def nla(t: int, data: bytes):
+    l = 4 + len(data)
+    return struct.pack("HH", l, t) + data + b"\0" * ((4 - l % 4) % 4)
+
+
+def nla_str(t: int, s: str):
+    return nla(t, s.encode() + b"\0")
+
+
+def nla_u32(t: int, v: int):
+    return nla(t, struct.pack("I", v))
+
+
+def parse_nla(data: bytes):
+    attrs = {}
+    while len(data) >= 4:
+        l, t = struct.unpack("HH", data[:4])
+        if l < 4:
+            break
+        attrs[t & 0x3fff] = data[4:l]
+        data = data[(l + 3) & ~3:]
+    return attrs
+
+
+def netns_path(ns_name: str):
+    return os.path.join("/var/run/netns", ns_name)
+
+
+def setns(fd: int):
+    if hasattr(os, "setns"):
+        os.setns(fd, CLONE_NEWNET)
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.setns(fd, CLONE_NEWNET) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+
+# switch the current thread into the namespace temporarily
+@contextlib.contextmanager
+def netns(ns_name: str):
+    self_fd = os.open("/proc/thread-self/ns/net", os.O_RDONLY)
+    ns_fd = os.open(netns_path(ns_name), os.O_RDONLY)
+    try:
+        setns(ns_fd)
+        yield
+    finally:
+        setns(self_fd)
+        os.close(ns_fd)
+        os.close(self_fd)
+
+
+# parse_addr parses "ADDR[/LEN]" into (family, packed address, prefix length).
+# It is much cheaper than `ipaddress`, which matters when there are thousands of routes.
+def parse_addr(addr: str):
+    if "/" in addr:
+        addr, plen = addr.split("/")
+        plen = int(plen)
+    else:
+        plen = None
+    family = socket.AF_INET6 if ":" in addr else socket.AF_INET
+    if plen is None:
+        plen = 128 if family == socket.AF_INET6 else 32
+    return family, socket.inet_pton(family, addr), plen
+
+
+def parse_table(t: str):
+    if t in TABLES:
+        return TABLES[t]
+    return int(t)
+
+
+class Netlink(object):
+    def __init__(self, ns_name: str = None):
+        """
+        `ns_name` is the name of the namespace under /var/run/netns, or `None` for the current namespace.
+        The socket is bound to the namespace when it is created, so the thread only stays there shortly.
+        """
+        if ns_name is None:
+            self.sock = self.open()
+        else:
+            with netns(ns_name):
+                self.sock = self.open()
+
+        self.seq = 0
+        self.pending = [] # [(seq, msg)]
+        self.acks = {} # seq -> errno
+        self.error = False
+        self.fds = [] # the fds which must be kept open until the messages are acked
+        self.indexes = None # name -> ifindex
+
+    def open(self):
+        s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        s.bind((0, 0))
+        return s
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request(self, t: int, flags: int, body: bytes):
+        self.seq += 1
+        msg = struct.pack("IHHII", 16 + len(body), t, flags | NLM_F_REQUEST | NLM_F_ACK, self.seq, 0) + body
+        self.pending.append((self.seq, msg))
+        if len(self.pending) >= MAX_INFLIGHT:
+            self.flush()
+        return self.seq
+
+    def recv(self):
+        data = self.sock.recv(1 << 16)
+        while len(data) >= 16:
+            l, t, _, seq, _ = struct.unpack("IHHII", data[:16])
+            yield t, seq, data[16:l]
+            data = data[(l + 3) & ~3:]
+
+    # flush sends all the pending messages at once and collects their ACKs
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        waiting = set(seq for seq, _ in self.pending)
+        self.sock.sendall(b"".join(msg for _, msg in self.pending))
+        self.pending = []
+
+        while len(waiting) > 0:
+            for t, seq, payload in self.recv():
+                if t == NLMSG_ERROR and seq in waiting:
+                    e = struct.unpack("i", payload[:4])[0]
+                    self.acks[seq] = e
+                    self.error = self.error or e != 0
+                    waiting.remove(seq)
+
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+    def load_indexes(self):
+        self.flush()
+        self.indexes = {}
+        self.seq += 1
+        body = struct.pack("BxHiII", socket.AF_UNSPEC, 0, 0, 0, 0)
+        self.sock.sendall(struct.pack("IHHII", 16 + len(body), RTM_GETLINK, NLM_F_REQUEST | NLM_F_DUMP, self.seq, 0) + body)
+        while True:
+            for t, seq, payload in self.recv():
+                if seq != self.seq:
+                    continue
+                if t == NLMSG_DONE:
+                    return
+                if t == NLMSG_ERROR:
+                    e = struct.unpack("i", payload[:4])[0]
+                    raise OSError(-e, os.strerror(-e))
+                index = struct.unpack("i", payload[4:8])[0]
+                attrs = parse_nla(payload[16:])
+                if IFLA_IFNAME in attrs:
+                    self.indexes[attrs[IFLA_IFNAME].rstrip(b"\0").decode()] = index
+
+    def index(self, name: str):
+        if self.indexes is None or name not in self.indexes:
+            # the link may be created by the messages not acked yet
+            self.load_indexes()
+        if name not in self.indexes:
+            raise OSError(19, f"Cannot find device \"{name}\"")
+        return self.indexes[name]
+
+    def link_add(self, name: str, kind: str, peer: str = None, peer_ns: str = None):
+        data = b""
+        if kind == "veth":
+            peer_attrs = nla_str(IFLA_IFNAME, peer)
+            if peer_ns is not None:
+                fd = os.open(netns_path(peer_ns), os.O_RDONLY)
+                self.fds.append(fd)
+                peer_attrs += nla_u32(IFLA_NET_NS_FD, fd)
+            data = nla(IFLA_INFO_DATA, nla(VETH_INFO_PEER, struct.pack("BxHiII", socket.AF_UNSPEC, 0, 0, 0, 0) + peer_attrs))
+        body = struct.pack("BxHiII", socket.AF_UNSPEC, 0, 0, 0, 0)
+        body += nla_str(IFLA_IFNAME, name)
+        body += nla(IFLA_LINKINFO, nla_str(IFLA_INFO_KIND, kind) + data)
+        return self.request(RTM_NEWLINK, NLM_F_CREATE | NLM_F_EXCL, body)
+
+    def link_set(self, name: str, up: bool = False, mtu: int = None):
+        flags = IFF_UP if up else 0
+        body = struct.pack("BxHiII", socket.AF_UNSPEC, 0, 0, flags, flags)
+        body += nla_str(IFLA_IFNAME, name)
+        if mtu is not None:
+            body += nla_u32(IFLA_MTU, mtu)
+        return self.request(RTM_NEWLINK, 0, body)
+
+    def link_del(self, name: str):
+        body = struct.pack("BxHiII", socket.AF_UNSPEC, 0, 0, 0, 0) + nla_str(IFLA_IFNAME, name)
+        return self.request(RTM_DELLINK, 0, body)
+
+    def addr_add(self, cidr: str, dev: str):
+        family, ip, plen = parse_addr(cidr)
+        body = struct.pack("BBBBI", family, plen, 0, RT_SCOPE_UNIVERSE, self.index(dev))
+        body += nla(IFA_LOCAL, ip) + nla(IFA_ADDRESS, ip)
+        return self.request(RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL, body)
+
+    def route(self, add: bool, dst: str, via: str, table: int):
+        family, gw, _ = parse_addr(via)
+        if dst == "default":
+            dst_len, attrs = 0, b""
+        else:
+            _, ip, dst_len = parse_addr(dst)
+            attrs = nla(RTA_DST, ip)
+        attrs += nla(RTA_GATEWAY, gw) + nla_u32(RTA_TABLE, table)
+
+        rt_table = table if table < 256 else RT_TABLE_UNSPEC
+        if add:
+            body = struct.pack("BBBBBBBBI", family, dst_len, 0, 0, rt_table, RTPROT_BOOT, RT_SCOPE_UNIVERSE, RTN_UNICAST, 0)
+            return self.request(RTM_NEWROUTE, NLM_F_CREATE | NLM_F_EXCL, body + attrs)
+        body = struct.pack("BBBBBBBBI", family, dst_len, 0, 0, rt_table, 0, RT_SCOPE_NOWHERE, 0, 0)
+        return self.request(RTM_DELROUTE, 0, body + attrs)
+
+    def rule(self, add: bool, fwmark: int, table: int):
+        rt_table = table if table < 256 else RT_TABLE_UNSPEC
+        body = struct.pack("BBBBBBBBI", socket.AF_INET, 0, 0, 0, rt_table, 0, 0, FR_ACT_TO_TBL, 0)
+        body += nla_u32(FRA_FWMARK, fwmark) + nla_u32(FRA_TABLE, table)
+        if add:
+            return self.request(RTM_NEWRULE, NLM_F_CREATE | NLM_F_EXCL, body)
+        return self.request(RTM_DELRULE, 0, body)
+
+    # submit translates one `ip` line into a netlink message
+    def submit(self, line: str):
+        args = line.split()
+        obj, op, args = args[0], args[1], args[2:]
+
+        if obj == "link":
+            if args[0] == "dev":
+                args = args[1:]
+            if op == "add":
+                name, kind = args[0], args[args.index("type") + 1]
+                peer = args[args.index("name") + 1] if kind == "veth" else None
+                peer_ns = args[args.index("netns") + 1] if "netns" in args else None
+                return self.link_add(name, kind, peer, peer_ns)
+            if op == "set":
+                name, up, mtu = None, False, None
+                i = 0
+                while i < len(args):
+                    if args[i] == "up":
+                        up = True
+                    elif args[i] in ("dev", "mtu"):
+                        if args[i] == "dev":
+                            name = args[i + 1]
+                        else:
+                            mtu = int(args[i + 1])
+                        i += 1
+                    else:
+                        name = args[i]
+                    i += 1
+                if name is None:
+                    raise ValueError(f"no device in ip line: {line}")
+                return self.link_set(name, up, mtu)
+            if op == "del":
+                return self.link_del(args[0])
+        if obj in ("addr", "address") and op == "add":
+            dev = args[args.index("dev") + 1]
+            cidr = [a for i, a in enumerate(args) if a != "dev" and (i == 0 or args[i - 1] != "dev")][0]
+            return self.addr_add(cidr, dev)
+        if obj == "route" and op in ("add", "del"):
+            return self.route(op == "add", args[0], args[args.index("via") + 1], parse_table(args[args.index("table") + 1]))
+        if obj == "rule" and op in ("add", "del"):
+            return self.rule(op == "add", int(args[args.index("fwmark") + 1], 0), parse_table(args[args.index("table") + 1]))
+        raise ValueError(f"unsupported ip line: {line}")
+
+    def apply(self, lines: list):
+        """
+        Applies the lines and returns the error of each line, which is `None` if the line succeeded.
+        Like `ip -batch`, the lines after the first failure are not executed.
+        Note the messages in flight together are all processed by the kernel, so a few lines after the failed one
+        may succeed as well, which is reported faithfully.
+        """
+        results = [NOT_EXECUTED] * len(lines)
+        seqs = []
+        for i, line in enumerate(lines):
+            if self.error:
+                break
+            try:
+                seqs.append((i, self.submit(line)))
+            except OSError as e:
+                results[i] = e.strerror
+                break
+            except (ValueError, IndexError) as e:
+                # a line which cannot be parsed fails like one rejected by the kernel
+                results[i] = str(e) if isinstance(e, ValueError) else f"invalid ip line: {line}"
+                break
+        self.flush()
+
+        for i, seq in seqs:
+            e = self.acks[seq]
+            results[i] = None if e == 0 else os.strerror(-e)
+        return results
@@ -0,0 +1,238 @@
+import asyncio
+import contextlib
+import contextvars
+import json
+import os
+import subprocess
+import threading
+import time
+import typing
+
+""" An asyncio engine running the privileged commands of `mesh`.
+
+The configs of `mesh` are applied from plain threads (see `mesh.DAGExecutor`), they submit their commands to a
+`Runner` and wait for the results. The `Runner` runs the commands on its own event loop:
+
+  * the commands of one namespace run one at a time, in the order they are submitted
+  * the commands of different namespaces run in parallel, at most `max_procs` at once
+  * stdout and stderr are captured, a failed command raises a `CommandError` carrying them
+
+A command is spawned as the shell command `wrap(ns, cmd)`, e.g. prefixed by `sudo`, or sent to the privileged
+helper if a `helper.Session` is used.
+
+If the `tracer` of a `Runner` is set, every command is recorded with its namespace, owner, time and exit status.
+While `recording`, the commands are recorded instead of being run, which needs neither root nor namespaces.
+"""
+
+
+# owner is the name of the config submitting commands from the current thread, see `Tracer`
+owner = contextvars.ContextVar("owner", default=None)
+
+
+class Tracer(object):
+    """
+    Tracer records spans of time, e.g. the compile passes, the configs brought up and the commands they run.
+    A span is (category, name, lane, start, end, args), the lanes are the rows of the Chrome trace, e.g. a namespace.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.events = []
+
+    def add(self, cat: str, name: str, lane: str, start: float, end: float, **args):
+        with self.lock:
+            self.events.append({"cat": cat, "name": name, "lane": lane, "start": start - self.start,
+                                "dur": end - start, "args": args})
+
+    @contextlib.contextmanager
+    def span(self, cat: str, name: str, lane: str, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(cat, name, lane, start, time.perf_counter(), **args)
+
+    def to_json(self):
+        return sorted(self.events, key=lambda e: e["start"])
+
+    # to_chrome returns the trace events read by chrome://tracing and Perfetto
+    def to_chrome(self):
+        lanes = {}
+        events = []
+        for e in self.to_json():
+            if e["lane"] not in lanes:
+                lanes[e["lane"]] = len(lanes) + 1
+                events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": lanes[e["lane"]],
+                               "args": {"name": e["lane"]}})
+            events.append({"name": e["name"], "cat": e["cat"], "ph": "X", "pid": 1, "tid": lanes[e["lane"]],
+                           "ts": e["start"] * 1e6, "dur": e["dur"] * 1e6, "args": e["args"]})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path: str, format: str = "chrome"):
+        with open(path, "w") as f:
+            json.dump(self.to_chrome() if format == "chrome" else self.to_json(), f, indent=1)
+
+
+class CommandError(Exception):
+    def __init__(self, ns: str, result: subprocess.CompletedProcess):
+        err = result.stderr.decode(errors="replace").strip()
+        super().__init__(f"`{result.args}` in {ns} exited with {result.returncode}" + (f": {err}" if err else ""))
+        self.ns = ns
+        self.cmd = result.args
+        self.returncode = result.returncode
+        self.stdout = result.stdout
+        self.stderr = result.stderr
+
+
+class Runner(object):
+    def __init__(self, max_procs: typing.Union[int, None] = None, wrap=None):
+        self.max_procs = max_procs if max_procs else min(32, (os.cpu_count() or 1) * 4)
+        self.wrap = wrap if wrap else lambda ns, cmd: cmd
+        self.session = None
+        self.tracer = None
+        self.records = None
+        self.loop = None
+        self.thread = None
+        self.start_lock = threading.Lock()
+        # created on the loop
+        self.procs = None
+        self.ns_locks = {}
+
+    # start starts the event loop in a daemon thread, it is called by the first command
+    def start(self):
+        with self.start_lock:
+            if self.loop:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name="runner", daemon=True)
+            self.thread.start()
+
+    def use_session(self, session):
+        if self.session is session:
+            return
+        self.close_session()
+        self.session = session
+
+    def close_session(self):
+        if self.session and self.loop:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.session = None
+
+    def stop(self):
+        self.close_session()
+        with self.start_lock:
+            if not self.loop:
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+            self.procs = None
+            self.ns_locks = {}
+
+    async def feed(self, stdin, input):
+        if isinstance(input, bytes):
+            input = [input]
+        try:
+            for chunk in input:
+                stdin.write(chunk)
+                await stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # the command exited early, its exit code tells why
+            pass
+        stdin.close()
+
+    async def exec(self, cmd: str, input):
+        p = await asyncio.create_subprocess_shell(
+            cmd,
+            stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        readers = [p.stdout.read(), p.stderr.read()]
+        if input is not None:
+            readers.append(self.feed(p.stdin, input))
+        out, err = (await asyncio.gather(*readers))[:2]
+        return subprocess.CompletedProcess(cmd, await p.wait(), out, err)
+
+    @contextlib.contextmanager
+    def recording(self):
+        """
+        Records the commands instead of running them, each one succeeds with no output.
+        Yields the list of the records, {"ns": ns, "cmd": cmd, "input": the text fed to stdin or None}.
+        """
+        assert(self.records is None)
+        self.records = []
+        try:
+            yield self.records
+        finally:
+            self.records = None
+
+    def record(self, ns: str, cmd: str, input=None, **kwargs):
+        if input is not None:
+            input = (input if isinstance(input, bytes) else b"".join(input)).decode()
+        self.records.append(dict({"ns": ns, "cmd": cmd, "input": input}, **kwargs))
+        return subprocess.CompletedProcess(cmd, 0, b"", b"")
+
+    # span records a span if the tracer is set
+    def span(self, cat: str, name: str, lane: str, **args):
+        if self.tracer is None:
+            return contextlib.nullcontext()
+        return self.tracer.span(cat, name, lane, **args)
+
+    # ordered awaits `job()` in the order of namespace `ns`
+    async def ordered(self, ns: str, job, name: str = None, owner: str = None):
+        if self.procs is None:
+            self.procs = asyncio.Semaphore(self.max_procs)
+        submitted = time.perf_counter()
+        # `asyncio.Lock` wakes up its waiters in order, so the commands of a namespace keep the order of submission
+        lock = self.ns_locks.setdefault(ns, asyncio.Lock())
+        async with lock:
+            async with self.procs:
+                start = time.perf_counter()
+                result = None
+                try:
+                    result = await job()
+                    return result
+                finally:
+                    if self.tracer and name:
+                        status = getattr(result, "returncode", None) if result is not None else "error"
+                        self.tracer.add("cmd", name, ns, start, time.perf_counter(), owner=owner, status=status,
+                                        queued=start - submitted)
+
+    async def arun(self, ns: str, cmd: str, input=None, check: bool = True, owner: str = None):
+        """
+        Runs the shell command `cmd` in namespace `ns`, `input` is the bytes or an iterable of the byte chunks fed to
+        its stdin. Returns the `subprocess.CompletedProcess`, or raises `CommandError` if `check`.
+        `owner` names the config running the command in the trace.
+        """
+        if self.records is not None:
+            job = lambda: asyncio.sleep(0, self.record(ns, cmd, input, owner=owner))
+        elif self.session:
+            job = lambda: self.session.exec(ns, cmd, input)
+        else:
+            job = lambda: self.exec(self.wrap(ns, cmd), input)
+        result = await self.ordered(ns, job, cmd, owner)
+        if check and result.returncode != 0:
+            raise CommandError(ns, result)
+        return result
+
+    def submit(self, ns: str, cmd: str, input=None, check: bool = True):
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self.arun(ns, cmd, input, check, owner.get()), self.loop)
+
+    # run is `arun` for the callers outside the loop, which waits for the result
+    def run(self, ns: str, cmd: str, input=None, check: bool = True):
+        assert(threading.current_thread() is not self.thread)
+        return self.submit(ns, cmd, input, check).result()
+
+    # apply_ip applies the `ip` lines in namespace `ns` by the session, see `helper.Session.apply_ip`
+    def apply_ip(self, ns: str, lines: list):
+        assert(self.session is not None)
+        if self.records is not None:
+            self.record(ns, "ip -batch -", "".join(l + "\n" for l in lines).encode(), owner=owner.get())
+            return [None] * len(lines)
+        self.start()
+        job = lambda: self.session.apply_ip(ns, lines)
+        name = f"ip ({len(lines)} lines)"
+        return asyncio.run_coroutine_threadsafe(self.ordered(ns, job, name, owner.get()), self.loop).result()
@@ -4,17 +4,34 @@ import time
 
 import example
 from cli import key_dir
-from mesh import NS
+from mesh import NS, Wg
 
 def test_gen_net_smoke():
     net = example.gen_net(True, mock_net = False)
 
+def test_gen_net_lazy():
+    # the keys do not need to exist until the network is compiled
+    net = example.gen_net(False, mock_net = False)
+    assert(net.hosts["bj"].key._sk == None)
+    assert(len([c for c in net.hosts["bj"].confs.conf if type(c) == Wg]) == 0)
+    # nor to compile it, they are only read when a link is configured
+    net.compile()
+    assert(net.hosts["bj"].key._sk == None)
+
+def test_plan():
+    # planning runs nothing, so it needs no root
+    net = example.gen_net(True, mock_net = False)
+    records = net.plan("bj")
+    cmds = [r["cmd"] for r in records]
+    assert(cmds[:3] == ["ip -batch -"] * 3)
+    assert(cmds.count("wg setconf bj.hk /dev/stdin") == 1)
+    assert(cmds[-1] == "iptables-restore --noflush")
+    assert(sorted(r["owner"] for r in records if r.get("daemon")) == ["AnyProxy(__global_ns)", "FreeDNS(__global_ns)"])
+
 def test_gen_net_mock():
     net = example.gen_net(True, mock_net = True)
     net.up_mock_net()
-    for h in net.hosts:
-        print(f"Starting {h}")
-        net.up(h)
+    net.up_hosts(list(net.hosts))
     
     assert(os.system(NS("iPhone").gen_cmd("ping 10.56.1.1 -c 1")) == 0)
     assert(os.system(NS("iPhone").gen_cmd("ping 10.56.1.2 -c 1")) == 0)
@@ -23,8 +40,7 @@ def test_gen_net_mock():
         assert(os.system(NS("iPhone").gen_cmd("host google.com 10.56.1.1")) == 0)
     # todo: test traceroute
 
-    for h in net.hosts:
-        net.down(h)
+    net.down_hosts(list(net.hosts))
     net.down_mock_net()
 
 def test_cli():
@@ -1,8 +1,16 @@
 from mesh import *
+import runner
+from runner import CommandError, Runner
 
+import base64
+import ipaddress
 import os
 import pytest
+import random
+import subprocess
+import sys
 import tempfile
+import threading
 import time 
 
 
@@ -23,6 +31,20 @@ def test_Key():
         assert(k1.sk == sk)
 
 
+def test_pubkey():
+    # the test vector from RFC 7748
+    sk = base64.b64encode(bytes.fromhex("77076d0a7318a57d3c16c17251b26645df4c2f87ebc0992ab177fba51db92c2a")).decode()
+    pk = base64.b64encode(bytes.fromhex("8520f0098930a754748b7ddcb43ef75a0dbf3a0d26381af4eba4a98eaa9b4e6a")).decode()
+    assert(pubkey(sk) == pk)
+
+    # consistent with wireguard-tools
+    k = Key(None)
+    assert(subprocess.getoutput("echo '%s' | wg pubkey" % k.sk) == k.pk)
+
+    keys = Key.gen_many(100)
+    assert(len(set(k.sk for k in keys)) == 100)
+
+
 def test_veth():
     left_ns = NS("left")
     right_ns = NS("right")
@@ -63,6 +85,23 @@ def test_wg():
     right_ns.down()
     left_ns.down()
 
+def test_gen_wg_conf():
+    left, right = gen_wg("wg0", Key(None, "lsk", "lpk"), Key(None, "rsk", "rpk"), right_wan_ip="10.1.1.2",
+                         link_cidr="192.168.1.8/30", port=1234, mtu=1420, left_ns=global_ns, right_ns=global_ns)
+    assert(left.gen_conf() == "[Interface]\nPrivateKey = lsk\nFwMark = 51820\n\n"
+        + "[Peer]\nPublicKey = rpk\nEndpoint = 10.1.1.2:1234\nAllowedIPs = 0.0.0.0/0\nPersistentKeepalive = 30\n")
+    assert(right.gen_conf() == "[Interface]\nPrivateKey = rsk\nFwMark = 51820\nListenPort = 1234\n\n"
+        + "[Peer]\nPublicKey = lpk\nAllowedIPs = 0.0.0.0/0\nPersistentKeepalive = 30\n")
+
+    iface = WgIface(Key(None, "sk", "pk"), None, 1420, global_ns)
+    iface.add_peer("10.0.0.1/30", "10.0.0.2", Key(None, "sk2", "pk2"), "1.1.1.1:1234")
+    iface.add_peer("10.0.0.5/30", "10.0.0.6", Key(None, "sk3", "pk3"), None)
+    iface.peers["10.0.0.2"][2] += ["10.0.0.0/30", "0.0.0.0/0"]
+    iface.peers["10.0.0.6"][2] += ["10.0.0.4/30"]
+    conf = iface.gen_conf()
+    assert("ListenPort" not in conf and conf.count("[Peer]") == 2)
+    assert("AllowedIPs = 10.0.0.0/30, 0.0.0.0/0\n" in conf and "AllowedIPs = 10.0.0.4/30\n" in conf)
+
 
 def test_IPTableRule():
     net = ConfSet()
@@ -82,6 +121,88 @@ def test_IPTableRule():
     net.down()
 
 
+def test_IPTableBatch():
+    net = ConfSet()
+    ns = NS("ns")
+    net.add(ns)
+    net.add(Veth("veth", "10.1.1.1/24", "10.1.1.2/24", global_ns, ns))
+    net.add(IPTableRule("filter", "OUTPUT", "-d 10.1.1.1 -j DROP", ns))
+    net.add(IPTableRule("mangle", "OUTPUT", "-d 10.1.1.1 -j MARK --set-mark 1", ns))
+
+    # the two rules are merged into one batch
+    batches = [c for c in net.compile() if type(c) == IPTableBatch]
+    assert(len(batches) == 1)
+    assert(batches[0].gen_restore_txt("-A", batches[0].rules) ==
+           "*filter\n-A OUTPUT -d 10.1.1.1 -j DROP\nCOMMIT\n*mangle\n-A OUTPUT -d 10.1.1.1 -j MARK --set-mark 1\nCOMMIT\n")
+
+    net.up()
+    assert(os.system(ns.gen_cmd("timeout 0.2 ping 10.1.1.1 -c 1")) != 0)
+    net.down()
+
+
+def test_IPBatch():
+    net = ConfSet()
+    a = NS("a")
+    b = NS("b")
+    net.add([
+        a,
+        b,
+        Veth("ab1", "192.168.1.1/24", "192.168.1.2/24", a, b),
+        Veth("ab2", "192.168.10.1/24", "192.168.10.2/24", a, b),
+        Route("192.168.20.0/24", "192.168.10.2", "main", a),
+        RouteRule("1", "1", a),
+    ])
+
+    # one `ip -batch` per (phase, namespace)
+    batches = [(c.phase, c.ns.ns_name) for c in net.compile()]
+    assert(batches == [(PHASE_NS, "__global_ns"), (PHASE_LINK, "a"), (PHASE_ADDR, "a"), (PHASE_ADDR, "b"), (PHASE_ROUTE, "a")])
+
+    net.up()
+    assert(os.system(a.gen_cmd("timeout 0.2 ping 192.168.10.2 -c 1")) == 0)
+    net.down()
+    assert(os.system(global_ns.gen_cmd("ip netns exec a ip addr")) != 0)
+
+
+# NetlinkBackend enters the namespaces itself, which needs running as root rather than through sudo
+@pytest.mark.skipif(os.geteuid() != 0, reason="needs root")
+def test_NetlinkBackend():
+    net = ConfSet(NetlinkBackend())
+    a = NS("a")
+    b = NS("b")
+    net.add([
+        a,
+        b,
+        Veth("ab1", "192.168.1.1/24", "192.168.1.2/24", a, b),
+        Route("192.168.20.0/24", "192.168.1.2", "main", a),
+        Route("default", "192.168.1.2", "1000", a),
+        RouteRule("1", "1000", a),
+    ])
+
+    net.up()
+    assert(os.system(a.gen_cmd("timeout 0.2 ping 192.168.1.2 -c 1")) == 0)
+    p = subprocess.run(["sh", "-c", a.gen_cmd("ip route show table 1000")], stdout=subprocess.PIPE)
+    assert("default via 192.168.1.2" in p.stdout.decode())
+    net.down()
+
+    # the failed line is reported and the applied ones are rolled back
+    net = ConfSet(NetlinkBackend())
+    net.add([a, Route("1.1.1.1", "192.168.1.1", "main", a)])
+    with pytest.raises(IPBatchError) as e:
+        net.up()
+    assert(e.value.lineno == 1)
+    assert(os.system(global_ns.gen_cmd("ip netns exec a ip addr")) != 0)
+
+
+def test_Netlink_invalid_line():
+    # a line which cannot be parsed fails the batch like a kernel error, no root is needed to get there
+    import netlink
+    with netlink.Netlink() as nl:
+        assert(nl.apply(["route frob 1.1.1.1", "link set dev lo up"]) == ["unsupported ip line: route frob 1.1.1.1",
+                                                                         netlink.NOT_EXECUTED])
+        assert(nl.apply(["link set up"]) == ["no device in ip line: link set up"])
+        assert(nl.apply(["route"]) == ["invalid ip line: route"])
+
+
 def test_IPSet():
     def is_in_ipset(ipset_name, ip):
         return os.system(f"sudo ipset test {ipset_name} {ip}") == 0
@@ -92,12 +213,51 @@ def test_IPSet():
     s1.down()
 
     cip = IPSet("china_ip", chinaip_list(), global_ns)
+    assert(cip.gen_create_opts() == f"family inet hashsize {len(cip.ips)} maxelem 65536")
     cip.up()
+    assert(int(cip.stat()["Number of entries"]) == len(cip.ips))
+    assert(cip.report()["entries"] == len(cip.ips))
     assert(is_in_ipset(cip.name, "114.114.114.114") == True)
     assert(is_in_ipset(cip.name, "8.8.8.8") == False)
+
+    # swap in the new contents, over a temporary set sized differently left by an interrupted refresh
+    assert(os.system("sudo ipset create china_ip-new hash:net hashsize 64 maxelem 128") == 0)
+    cip.refresh(["8.8.8.0/24"])
+    assert(is_in_ipset(cip.name, "114.114.114.114") == False)
+    assert(is_in_ipset(cip.name, "8.8.8.8") == True)
+    assert(os.system("sudo ipset list china_ip-new") != 0)
     cip.down()
 
 
+def test_load_cidr_file():
+    assert(collapse_cidrs(["10.0.0.0/25", "10.0.0.128/25", "10.0.0.5/32", "10.0.1.0/24"]) == ["10.0.0.0/23"])
+    assert(collapse_cidrs(["10.0.0.0/24", "10.0.2.0/24"]) == ["10.0.0.0/24", "10.0.2.0/24"])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        p = os.path.join(tmp_dir, "list.txt")
+        with open(p, "w") as f:
+            f.write("1.0.0.0/24\n1.0.1.0/24\nfe80::/64\n")
+        assert(load_cidr_file(p) == ["1.0.0.0/23", "fe80::/64"])
+        assert(os.path.exists(p + ".cache"))
+        # loaded from the cache
+        assert(load_cidr_file(p) == ["1.0.0.0/23", "fe80::/64"])
+
+        # a truncated cache is ignored and written again
+        with open(p + ".cache", "rb") as f:
+            cache = f.read()
+        with open(p + ".cache", "wb") as f:
+            f.write(cache[:-3])
+        assert(load_cidr_file(p) == ["1.0.0.0/23", "fe80::/64"])
+        with open(p + ".cache", "rb") as f:
+            assert(f.read() == cache)
+        assert(sorted(os.listdir(tmp_dir)) == ["list.txt", "list.txt.cache"])
+
+        # the cache is invalidated when the source changes
+        with open(p, "w") as f:
+            f.write("1.0.0.0/24\n")
+        assert(load_cidr_file(p) == ["1.0.0.0/24"])
+
+
 def test_IPSetBundle():
     a = IPSet("a", ["192.168.1.0/24"], global_ns)
     b = IPSet("b", ["192.168.2.0/24"], global_ns)
@@ -135,6 +295,259 @@ def test_RouteRule():
     a_rule.down()
     net.down()
 
+def test_NftRuleset():
+    wan = IPSet("wan", ["40.0.1.0/24"])
+    pri = IPSet("pri", privateip_list())
+    bundle = IPSetBundle(match=[wan], not_match=[pri])
+
+    h = Host("h", "", Key(None), global_ns)
+    h.add_ipset(wan)
+    h.add_ipset(pri)
+    h.policy_route(False, False, "10.0.0.1", bundle, "10.0.0.6")
+    h.policy_route(False, False, "10.0.0.9", bundle, "10.0.0.6")
+    h.render_firewall("nft")
+
+    nft = [c for c in h.confs.conf if type(c) == NftRuleset]
+    assert(len(nft) == 1)
+    txt = nft[0].gen_txt()
+    assert("elements = { 40.0.1.0/24 }" in txt)
+    # one map lookup dispatches the per source rules
+    assert("10.0.0.1 : jump prerouting_10_0_0_1, 10.0.0.9 : jump prerouting_10_0_0_9" in txt)
+    assert("ip daddr @wan ip daddr != @pri meta mark 0 meta mark set 100" in txt)
+    assert("ip saddr vmap @prerouting_src" in txt)
+    # no ipsets or iptables rules are needed
+    assert(all(type(c) != IPSet and type(c) != IPTableRule for c in h.confs.conf))
+
+def test_gen_iptables_rules():
+    wan = IPSet("wan", ["40.0.1.0/24"])
+    bundle = IPSetBundle(match=[wan], not_match=[])
+
+    h = Host("h", "", Key(None), global_ns)
+    h.add_ipset(wan)
+    for i in range(100):
+        h.policy_route(False, False, f"10.0.{i}.1", bundle, "10.0.0.6")
+    h.policy_route(False, False, "10.1.0.1", bundle, "10.0.0.10")
+    h.policy_route(True, False, "10.0.0.5", bundle, "10.0.0.6")
+    h.policy_route(True, False, "10.0.0.5", IPSetBundle(match=[], not_match=[wan]), "10.0.0.6")
+    ipsets, rules = h.gen_iptables_rules(h.assign_route_tables())
+
+    # the sources sharing a bundle and a next hop are matched by one set
+    assert(len(ipsets) == 1 and len(ipsets[0].ips) == 100)
+    assert([r.rule for r in rules if r.chain == "PREROUTING"] == [
+        "-m set --match-set wan dst -m mark --mark 0 -m set --match-set src-fwd-0 src -j MARK --set-mark 100",
+        "-m set --match-set wan dst -m mark --mark 0 -s 10.1.0.1 -j MARK --set-mark 101",
+    ])
+    # one mark, table and ip rule per next hop, and the local output is SNAT-ed once
+    assert(len([c for c in h.confs.conf if type(c) == Route]) == 2)
+    assert(len([c for c in h.confs.conf if type(c) == RouteRule]) == 2)
+    assert([r.rule for r in rules if r.chain == "POSTROUTING"] == ["-m connmark --mark 100 -j SNAT --to-source 10.0.0.5"])
+    # the mark of the local output is restored once for both bundles
+    assert([r.rule for r in rules if r.chain == "OUTPUT"][2:] == ["-m connmark --mark 100 -j MARK --set-mark 100"])
+
+    # the groups of the same sources share a set
+    h = Host("h", "", Key(None), global_ns)
+    h.add_ipset(wan)
+    for b in [bundle, IPSetBundle(match=[], not_match=[wan])]:
+        for i in range(3):
+            h.policy_route(False, False, f"10.0.{i}.1", b, "10.0.0.6")
+    ipsets, rules = h.gen_iptables_rules(h.assign_route_tables())
+    assert(len(ipsets) == 1 and sum("--match-set src-fwd-0 src" in r.rule for r in rules) == 2)
+
+    # a source whose rules would be reordered by the grouping keeps its own rules
+    assert(Host.group_sources([("a", "s1"), ("b", "s1"), ("b", "s2"), ("a", "s2")]) ==
+        [("a", ["s1"]), ("b", ["s1"]), ("b", ["s2"]), ("a", ["s2"])])
+
+
+def test_Routes():
+    def routes(summarize_routes):
+        net = Network(mock_net = False, summarize_routes = summarize_routes)
+        for h in ["a", "b", "c", "d"]:
+            net.add_host(h, "", Key(None, "sk", "pk"))
+        net.connect("a", "b", "10.0.0.0/30", 50000)
+        net.connect("b", "c", "10.0.0.4/30", 50001)
+        net.connect("b", "d", "10.0.0.8/30", 50002)
+        net._pass_1_compute_static_route()
+        return {name: [c for c in h.confs.conf if type(c) == Routes] for name, h in net.hosts.items()}
+
+    r = routes(False)
+    # `b` is directly connected to all others
+    assert(r["b"] == [])
+    assert(sorted(r["a"][0].routes()) == [
+        ("10.0.0.10", "10.0.0.2"), ("10.0.0.5", "10.0.0.2"), ("10.0.0.6", "10.0.0.2"), ("10.0.0.9", "10.0.0.2")])
+    assert(len(r["c"][0]) == 4 and len(r["d"][0]) == 4)
+    assert(r["d"][0].ip_up_lines()[0][2].endswith("via 10.0.0.9 table main"))
+
+    # the summary covers the link of `a` itself, which is routed by the more specific link route
+    r = routes(True)
+    assert(sorted(r["a"][0].routes()) == [("10.0.0.0/29", "10.0.0.2"), ("10.0.0.8/30", "10.0.0.2")])
+    assert(sorted(r["c"][0].routes()) == [("10.0.0.0/29", "10.0.0.5"), ("10.0.0.8/30", "10.0.0.5")])
+
+def test_summarize_routes_weighted():
+    # the next hop of every host towards every address of the other hosts, by the longest prefix match over
+    # its static routes and the link routes to its peers
+    def next_hops(net):
+        result = {}
+        for h in net.hosts.values():
+            table = []
+            for left, right, cidr, _ in net.links:
+                lip, rip = [a.split("/")[0] for a in link_addrs(cidr)]
+                if h.name in (left, right):
+                    table.append((ipaddress.ip_network(cidr), rip if h.name == left else lip))
+            for r in h.confs.conf:
+                if type(r) == Routes:
+                    table += [(ipaddress.ip_network(cidr), via) for cidr, via in r.routes()]
+            for o in net.hosts.values():
+                for addr in o.lan_cidrs:
+                    if o is not h:
+                        match = [(n.prefixlen, via) for n, via in table if ipaddress.ip_address(addr) in n]
+                        result[(h.name, addr)] = max(match)[1] if match else None
+        return result
+
+    rng = random.Random(0)
+    for _ in range(40):
+        n = rng.randint(3, 8)
+        edges = [(rng.randrange(i), i) for i in range(1, n)]
+        edges += [(i, j) for i in range(n) for j in range(i + 1, n) if rng.random() < 0.3 and (i, j) not in edges]
+        weights = [rng.choice([None, 1, 2, 5]) for _ in edges]
+        results = []
+        for summarize in (False, True):
+            net = Network(mock_net = False, summarize_routes = summarize)
+            for i in range(n):
+                net.add_host(f"h{i}", "", Key(None, "sk", "pk"))
+            for k, ((i, j), w) in enumerate(zip(edges, weights)):
+                net.connect(f"h{i}", f"h{j}", f"10.0.0.{4 * k}/30", 50000 + k, w)
+            net.compile()
+            results.append(next_hops(net))
+        assert(results[0] == results[1])
+
+def test_shortest_path_tree():
+    def gen(weight):
+        net = Network(mock_net = False)
+        for h in ["a", "b", "c", "d"]:
+            net.add_host(h, "", Key(None, "sk", "pk"))
+        net.connect("a", "b", "10.0.0.0/30", 50000, weight)
+        net.connect("b", "c", "10.0.0.4/30", 50001)
+        net.connect("a", "d", "10.0.0.8/30", 50002, 5)
+        net.connect("d", "c", "10.0.0.12/30", 50003)
+        return net
+
+    # without weights, the tree takes the fewest hops
+    net = Network(mock_net = False)
+    for h in ["a", "b", "c"]:
+        net.add_host(h, "", Key(None, "sk", "pk"))
+    net.connect("a", "b", "10.0.0.0/30", 50000)
+    net.connect("b", "c", "10.0.0.4/30", 50001)
+    assert(net.shortest_path_tree("a")["c"][4] == "b")
+
+    # a-b-c is cheaper than a-d-c
+    net = gen(1)
+    assert(net.shortest_path_tree("a")["c"][4] == "b")
+    net.output_to_nat_gateway(IPSetBundle(match=[], not_match=[]), "a", "c")
+    net._pass_2_output_to_nat_gateway()
+    assert(len(net.hosts["b"].policies) == 1 and len(net.hosts["d"].policies) == 0)
+
+    # a slow a-b link makes the egress path go through d
+    net = gen(10)
+    tree = net.shortest_path_tree("a")
+    assert(tree["c"][4] == "d" and tree["b"][4] == "c")
+    net.output_to_nat_gateway(IPSetBundle(match=[], not_match=[]), "a", "c")
+    net._pass_2_output_to_nat_gateway()
+    assert(len(net.hosts["b"].policies) == 0 and len(net.hosts["d"].policies) == 1)
+    assert(net.hosts["a"].policies[0][3] == "10.0.0.10")
+
+def test_summarize_routes():
+    a = Host("a", "", Key(None), global_ns)
+    b = Host("b", "", Key(None), global_ns)
+    for ip in ["10.0.0.1", "10.0.0.2", "10.0.0.5", "10.0.0.6", "10.0.1.0/24"]:
+        a.claim_lan_cidr(ip)
+    b.claim_lan_cidr("10.0.1.1")
+    prefixes, others = claimed_prefixes([a, b], [("a", "b", "10.0.0.0/30", 1), ("a", "b", "10.0.0.4/30", 2)])
+    assert(others == [])
+    # the overlapping cidrs are never merged
+    assert([p for p in prefixes if p[3]] == [(0x0a000100, 24, 0, True), (0x0a000101, 32, 1, True)])
+
+    s = summarize_routes(prefixes, ["x", "y", None])
+    assert([(n, p, l) for n, p, l, _ in s] == [
+        (0x0a000000, 29, "x"), (0x0a000100, 24, "x"), (0x0a000101, 32, "y")])
+    # an unreachable host can not be covered
+    s = summarize_routes(prefixes, [False, "y", None])
+    assert([(n, p, l) for n, p, l, _ in s if l] == [(0x0a000101, 32, "y")])
+
+def test_Network_nft():
+    net = Network(mock_net = True, firewall = "nft")
+    net.add_host("a", "40.0.1.23", Key(None))
+    net.add_host("b", "50.0.1.23", Key(None))
+    net.add_host("c", "60.0.1.23", Key(None))
+    net.connect("a", "b", "10.0.0.0/30", 50000)
+    net.connect("b", "c", "10.0.0.4/30", 50001)
+
+    wan = IPSet("wan", ["40.0.1.23", "50.0.1.23", "60.0.1.23"])
+    pri = IPSet("pri", privateip_list())
+    net.output_to_nat_gateway(IPSetBundle(match=[wan], not_match=[pri]), "a", "c")
+
+    net.up_mock_net()
+    for h in ["a", "b", "c"]:
+        net.up(h)
+
+    assert(os.system(NS("a").gen_cmd("ping 10.0.0.6 -c 1")) == 0)
+    # the wan traffic of `a` goes through `b` to the nat gateway `c`
+    p = subprocess.run(["sh", "-c", NS("a").gen_cmd("traceroute 50.0.1.23")], stdout=subprocess.PIPE)
+    assert(p.returncode == 0)
+    assert("10.0.0.2" in p.stdout.decode())
+
+    for h in ["a", "b", "c"]:
+        net.down(h)
+    net.down_mock_net()
+
+def test_Network_single_interface():
+    net = Network(mock_net = True, single_interface = True)
+    net.add_host("a", "40.0.1.23", Key(None))
+    net.add_host("b", "50.0.1.23", Key(None))
+    net.add_host("c", "60.0.1.23", Key(None))
+    net.add_host("d", "70.0.1.23", Key(None))
+    net.connect("a", "b", "10.0.0.0/30", 50000)
+    net.connect("c", "b", "10.0.0.4/30", 50001)
+    net.connect("b", "d", "10.0.0.8/30", 50002)
+
+    wan = IPSet("wan", ["40.0.1.23", "50.0.1.23", "60.0.1.23", "70.0.1.23"])
+    net.output_to_nat_gateway(IPSetBundle(match=[wan], not_match=[]), "a", "d")
+    net.compile()
+
+    # `b` accepts both `a` and `c` on one port
+    b = net.hosts["b"].wg_iface
+    assert([type(c) for c in net.hosts["b"].confs.conf].count(WgIface) == 1)
+    assert(b.port == 50000 and net.endpoint_port("c", "b") == 50000)
+    assert(b.addrs == ["10.0.0.2/30", "10.0.0.6/30", "10.0.0.9/30"])
+    assert(b.peers["10.0.0.1"][2] == ["10.0.0.0/30"])
+    assert(b.peers["10.0.0.10"][2] == ["10.0.0.8/30", "0.0.0.0/0"])
+    assert(net.hosts["a"].wg_iface.peers["10.0.0.2"][2] == ["0.0.0.0/0"])
+
+    net.up_mock_net()
+    for h in ["a", "b", "c", "d"]:
+        net.up(h)
+
+    assert(os.system(NS("a").gen_cmd("ping 10.0.0.5 -c 1")) == 0)
+    assert(os.system(NS("c").gen_cmd("ping 10.0.0.10 -c 1")) == 0)
+    p = subprocess.run(["sh", "-c", NS("a").gen_cmd("traceroute 50.0.1.23")], stdout=subprocess.PIPE)
+    assert(p.returncode == 0)
+    assert("10.0.0.2" in p.stdout.decode())
+
+    for h in ["a", "b", "c", "d"]:
+        net.down(h)
+    net.down_mock_net()
+
+
+def test_Network_mtu():
+    for single_interface in (False, True):
+        net = Network(mock_net = True, single_interface = single_interface, mtu = 1420)
+        net.add_host("a", "40.0.1.23", Key(None, "sk", "pk"))
+        net.add_host("b", "50.0.1.23", Key(None, "sk", "pk"))
+        net.connect("a", "b", "10.0.0.0/30", 50000)
+        for h in ["a", "b"]:
+            cmds = "".join(r["cmd"] + "\n" + (r["input"] or "") for r in net.plan(h))
+            assert(cmds.count("link set mtu 1420 ") == 1)
+
+
 def test_AnyProxy():
     # somke test
     pass
@@ -151,6 +564,42 @@ def test_AnyProxy():
     # assert(os.path.exists(log_path))
     # os.remove(log_path)
 
+def test_Supervisor():
+    def wait_until(cond, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not cond():
+            assert(time.monotonic() < deadline)
+            time.sleep(0.01)
+
+    exits = []
+    s = Supervisor(min_backoff=0.05, stable=100, on_exit=lambda d, code, backoff: exits.append((d.name, code, backoff)))
+    serve = f"{sys.executable} -c 'import socket, time; s = socket.socket(); s.bind((\"127.0.0.1\", 31400)); s.listen(); time.sleep(100)'"
+    d = Daemon("server", serve, lambda: listening(global_ns, "tcp", 31400))
+    s.start(d)
+    assert(listening(global_ns, "tcp", 31400))
+
+    # a crash is noticed and restarted
+    p = d.p
+    p.kill()
+    p.wait()
+    wait_until(lambda: d.p is not p)
+    s.wait_ready(d, 10)
+    assert(d.restarts == 1 and exits == [("server", -9, 0.05)])
+    s.stop(d)
+    assert(d.p.poll() is not None)
+
+    # a crash loop backs off, the backoff doubles on every exit
+    exits.clear()
+    d = Daemon("crash", "sleep 0.01; exit 1", lambda: True)
+    s.start(d)
+    wait_until(lambda: len(exits) >= 3)
+    s.stop(d)
+    assert([backoff for _, _, backoff in exits[:3]] == [0.05, 0.1, 0.2])
+
+    with pytest.raises(RuntimeError):
+        s.start(Daemon("exit", "exit 1", lambda: False))
+
+
 def test_FreeDNS():
     f = FreeDNS("-l 127.0.0.1:5353", False, global_ns)
     f.up()
@@ -169,6 +618,138 @@ def test_ConfSet():
     # ns should be deleted by net due to the exception
     assert(os.system(global_ns.gen_cmd("ip netns exec ns ip addr")) != 0)
 
+def test_DAGExecutor():
+    log = []
+    class Conf(object):
+        def __init__(self, name, fail=False, barrier=None):
+            self.name = name
+            self.fail = fail
+            self.barrier = barrier
+        def up(self):
+            if self.barrier:
+                # passes only once all the confs sharing the barrier are running
+                self.barrier.wait()
+            if self.fail:
+                time.sleep(0.1)
+                raise RuntimeError(self.name)
+            log.append(("up", self.name))
+        def down(self):
+            log.append(("down", self.name))
+
+    # b and c only depend on a, so they run together
+    barrier = threading.Barrier(2, timeout=10)
+    confs = [Conf("a"), Conf("b", barrier=barrier), Conf("c", barrier=barrier), Conf("d")]
+    deps = [[], [0], [0], [1, 2]]
+    DAGExecutor(max_workers=4).up(confs, deps)
+    assert(log[0] == ("up", "a") and log[3] == ("up", "d"))
+
+    log.clear()
+    DAGExecutor().down(confs, deps)
+    assert(log[0] == ("down", "d") and log[3] == ("down", "a"))
+
+    # the confs that are up are rolled back in the reverse order
+    log.clear()
+    confs = [Conf("a"), Conf("b"), Conf("c", fail=True), Conf("d")]
+    with pytest.raises(RuntimeError):
+        DAGExecutor().up(confs, [[], [0], [0], [1, 2]])
+    assert(log == [("up", "a"), ("up", "b"), ("down", "b"), ("down", "a")])
+
+def test_Runner():
+    r = Runner(max_procs=4)
+    # the commands of a namespace run in order, the namespaces run in parallel
+    with tempfile.TemporaryDirectory() as d:
+        # the first command of every namespace waits for the ones of the others, so they have to run at once
+        wait_all = "; ".join(f"until [ -e {d}/{ns}0 ]; do sleep 0.01; done" for ns in "abc")
+        futs = []
+        for ns in "abc":
+            futs.append(r.submit(ns, f"touch {d}/{ns}0; timeout 10 sh -c '{wait_all}' && touch {d}/{ns}0.done && echo {ns}0"))
+            futs.append(r.submit(ns, f"test -e {d}/{ns}0.done && echo {ns}1"))
+        outs = [f.result().stdout.decode().strip() for f in futs]
+    assert(outs == ["a0", "a1", "b0", "b1", "c0", "c1"])
+
+    assert(r.run("a", "cat", input=(b"%d\n" % i for i in range(3))).stdout == b"0\n1\n2\n")
+    with pytest.raises(CommandError) as e:
+        r.run("a", "echo oops >&2; exit 3")
+    assert(e.value.returncode == 3 and e.value.stderr == b"oops\n")
+    assert(r.run("a", "exit 1", check=False).returncode == 1)
+    r.stop()
+
+
+def test_Tracer():
+    r = Runner()
+    r.tracer = runner.Tracer()
+    token = runner.owner.set("IPSet(wan)")
+    r.run("a", "true")
+    runner.owner.reset(token)
+    r.run("b", "exit 2", check=False)
+    r.stop()
+    cmds = r.tracer.to_json()
+    assert([(e["name"], e["lane"], e["args"]["owner"], e["args"]["status"]) for e in cmds] ==
+           [("true", "a", "IPSet(wan)", 0), ("exit 2", "b", None, 2)])
+
+    # the compile passes are traced as well
+    command_runner.tracer = runner.Tracer()
+    try:
+        net = Network(mock_net=False)
+        net.add_host("a", "1.1.1.1", Key(None, "sk", "pk"))
+        net.add_host("b", "2.2.2.2", Key(None, "sk", "pk"))
+        net.connect("a", "b", "10.0.0.0/30", 5000)
+        net.compile()
+        trace = command_runner.tracer.to_chrome()
+    finally:
+        command_runner.tracer = None
+    names = [e["name"] for e in trace["traceEvents"] if e["ph"] == "X"]
+    assert(names == ["_pass_0_build_links", "_pass_1_compute_static_route", "_pass_2_output_to_nat_gateway",
+                     "_pass_3_render_firewall"])
+    assert(trace["traceEvents"][0] == {"name": "thread_name", "ph": "M", "pid": 1, "tid": 1, "args": {"name": "compile"}})
+
+
+def test_Session():
+    # the helper runs without sudo here, so only its own namespace is usable
+    r = Runner()
+    r.use_session(helper.Session(root_ns="root", cmd=[sys.executable, helper.__file__]))
+    assert(r.run("root", "echo hi").stdout == b"hi\n")
+    assert(r.run("root", "cat", input=[b"a", b"b"]).stdout == b"ab")
+    with pytest.raises(CommandError) as e:
+        r.run("root", "echo oops >&2; exit 3")
+    assert(e.value.returncode == 3 and e.value.stderr == b"oops\n")
+    with pytest.raises(RuntimeError):
+        r.run("no-such-ns", "true")
+    r.stop()
+
+    # defining a network does not replace the session of the running one
+    net = Network(mock_net = False, session = True)
+    assert(command_runner.session is not net.session)
+
+def test_diff_confs():
+    def gen(clients):
+        net = Network(mock_net=False)
+        key = Key(None, "sk", "pk")
+        net.add_host("hub", "1.1.1.1", key)
+        net.add_host("gw", "2.2.2.2", key)
+        net.connect("hub", "gw", "10.0.0.0/30", 5000)
+        wan = IPSet("wan", ["8.8.8.0/24"])
+        for i in range(clients):
+            net.add_host(f"c{i}", "", key)
+            net.connect(f"c{i}", "hub", f"10.1.{i}.0/30", 6000 + i)
+            net.output_to_nat_gateway(IPSetBundle(match=[wan], not_match=[]), f"c{i}", "gw")
+        net.compile()
+        return net
+
+    old = gen(5)
+    steps, confs = diff_confs(old.hosts["hub"].confs.conf, gen(5).hosts["hub"].confs.conf)
+    assert(steps == [])
+    assert(all(a is b for a, b in zip(confs, old.hosts["hub"].confs.conf) if type(a) != IPTableRule))
+
+    # adding a client brings up its link on the hub and swaps the rules, the other links are untouched
+    steps, _ = diff_confs(old.hosts["hub"].confs.conf, gen(6).hosts["hub"].confs.conf)
+    assert([(op, [type(c) for c in cs]) for op, cs in steps] == [("up", [Wg]), ("up", [Update])])
+
+    # removing one deletes the routes to it on the gateway
+    steps, _ = diff_confs(old.hosts["gw"].confs.conf, gen(4).hosts["gw"].confs.conf)
+    assert([(op, [type(c) for c in cs]) for op, cs in steps] == [("down", [Routes]), ("up", [Update])])
+    assert(steps[0][1][0].via == {"10.0.0.1": [["10.1.4.0/30"]]})
+
 
 def test_Network():
     net = Network(mock_net = True)